@@ -0,0 +1,453 @@
+"""
+Benchmarks of app_state hot paths.
+
+Usage:
+
+    python bench.py [benchmark_name ...] [--json results.json]
+                    [--compare baseline.json] [--threshold 0.2]
+
+Each benchmark_* function returns number of operations per second, or a
+dict of named measurements. Measurements ending with 'ops/s' are better
+when higher, all others (seconds, sizes, counts) when lower.
+
+With --compare, exit with status 1 if any measurement is worse than the
+baseline by more than the threshold fraction.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from timeit import repeat
+
+sys.path.insert(0, str(Path(__file__).parent / 'src'))
+
+from app_state import state, on, Storage
+
+
+def ops_per_second(func, number=10000) -> float:
+    """ Best of 5 runs. """
+    return number / min(repeat(func, number=number, repeat=5))
+
+
+def deep_tree(width=100, depth=5) -> dict:
+    """ Tree of `width` branches, each nested `depth` levels deep. """
+    tree = {}
+    for i in range(width):
+        branch = {'value': i}
+        for level in reversed(range(depth - 1)):
+            branch = {f'level{level}': branch}
+        tree[f'branch{i}'] = branch
+    return tree
+
+
+def benchmark_deep_attribute_read() -> float:
+    state.reset()
+    state.tree = deep_tree()
+
+    def read():
+        return state.tree.branch50.level0.level1.level2.level3.value
+
+    return ops_per_second(read)
+
+
+def benchmark_deep_item_read() -> float:
+    state.reset()
+    state.tree = deep_tree()
+
+    def read():
+        return state['tree']['branch50']['level0']['level1']['level2']['level3']['value']
+
+    return ops_per_second(read)
+
+
+def benchmark_large_list_read() -> float:
+    state.reset()
+    state.records = [{'id': i} for i in range(20000)]
+
+    def read():
+        return state.records[10000].id
+
+    return ops_per_second(read)
+
+
+def benchmark_deep_write() -> dict:
+    """ Writes to an existing node, nested 2 to 10 levels deep. """
+    results = {}
+    for depth in (2, 4, 6, 8, 10):
+        state.reset()
+        state.tree = deep_tree(width=10, depth=depth - 1)
+        node = state.tree.branch5
+        for level in range(depth - 2):
+            node = node[f'level{level}']
+
+        def write():
+            node.value = 1
+
+        results[f'depth {depth} ops/s'] = ops_per_second(write)
+    return results
+
+
+def countries_response(size=5000) -> dict:
+    return {
+        f'C{i}': {'name': f'Country {i}', 'population': i, 'cities': [f'City {i}']}
+        for i in range(size)
+    }
+
+
+def benchmark_update_noop() -> float:
+    """ Update of 5000 countries with equal values. """
+    state.reset()
+    state.countries = countries_response()
+    response = countries_response()
+
+    def update():
+        state.countries.update(response)
+
+    return ops_per_second(update, number=10)
+
+
+def benchmark_update_bulk() -> float:
+    """ Update of empty branch with 5000 new countries. """
+    state.reset()
+    response = countries_response()
+
+    def update():
+        state.countries = {}
+        state.countries.update(response)
+
+    return ops_per_second(update, number=10)
+
+
+def benchmark_update_small_delta() -> float:
+    """ Update of 5000 countries, with one population changed. """
+    state.reset()
+    state.countries = countries_response()
+    response = countries_response()
+
+    def update():
+        response['C50']['population'] += 1
+        state.countries.update(response)
+
+    return ops_per_second(update, number=10)
+
+
+def benchmark_persist_small_change() -> float:
+    """ Flush of a one-field change to a state with 100 large branches. """
+    with TemporaryDirectory() as tmp:
+        state.reset()
+        state.autopersist(Path(tmp) / 'state', timeout=0)
+        state.update(deep_tree(width=100, depth=3))
+        for branch in state.values():
+            branch.records = [{'id': i, 'name': f'record {i}'} for i in range(100)]
+
+        def write():
+            state.branch50.level0.level1.value += 1
+
+        try:
+            return ops_per_second(write, number=100)
+        finally:
+            state._appstate_persist.disconnect()
+
+
+def benchmark_async_burst() -> dict:
+    """ Burst of 10,000 writes, each triggering an async handler. """
+    runs = []
+
+    async def on_prices():
+        runs.append(1)
+        await asyncio.sleep(0)
+
+    async def burst():
+        state.reset()
+        state.prices = {}
+        runs.clear()
+        start = perf_counter()
+        for i in range(10_000):
+            state.prices.value = i
+        while len(asyncio.all_tasks()) > 1:
+            await asyncio.sleep(0)
+        return perf_counter() - start
+
+    handler = on('state.prices')(on_prices)
+    try:
+        seconds = asyncio.run(burst())
+    finally:
+        handler.disconnect()
+    return {'burst s': seconds, 'handler runs': len(runs)}
+
+
+def benchmark_memory() -> dict:
+    """ Memory of a tree of 1M nodes, compared to the plain nested dicts. """
+    state.reset()
+    tracemalloc.start()
+    data = {
+        f'R{i}': {'name': f'Record {i}', 'info': {'id': i}, 'geo': {'x': 1}, 'tags': ['a']}
+        for i in range(250_000)
+    }
+    plain = tracemalloc.get_traced_memory()[0]
+    state.tree = data
+    nodes = tracemalloc.get_traced_memory()[0] - plain
+    tracemalloc.stop()
+    state.reset()
+    return {'plain MB': plain / 1e6, 'state MB': nodes / 1e6, 'state/plain ratio': nodes / plain}
+
+
+def benchmark_trigger() -> dict:
+    """
+    Write of a value, with 10, 1000 and 10,000 handlers subscribed, and
+    with 1000 wildcard patterns.
+    """
+    results = {}
+    for count in (10, 1000, 10_000):
+        state.reset()
+        handlers = [on(f'state.p{i}.value')(lambda: None) for i in range(count)]
+        state.p5.value = 0
+
+        def write():
+            state.p5.value += 1
+
+        results[f'{count} patterns ops/s'] = ops_per_second(write)
+        for handler in handlers:
+            handler.disconnect()
+
+    # Wildcard patterns, matched through the index as well.
+    state.reset()
+    handlers = [on(f'state.*.value{i}')(lambda: None) for i in range(1000)]
+    handlers.append(on('state.**.value')(lambda: None))
+    state.p5.value = 0
+    results['1000 wildcard patterns ops/s'] = ops_per_second(write)
+    for handler in handlers:
+        handler.disconnect()
+    return results
+
+
+def benchmark_method_handlers() -> float:
+    """ Write, calling a method handler of 1000 instances. """
+    def refresh(self):
+        pass
+
+    handler = on('state.user')(refresh)
+    Widget = type('Widget', (), {'refresh': handler})
+
+    state.reset()
+    state.user.name = 'Alice'
+    # Instances are only kept alive by the list, while measuring.
+    widgets = [Widget() for i in range(1000)]
+
+    def write():
+        state.user.age = 1
+
+    try:
+        return ops_per_second(write, number=100)
+    finally:
+        handler.disconnect()
+        del widgets
+
+
+def benchmark_instance_handlers() -> float:
+    """
+    Write to one country, with a method handler of 5000 instances, each
+    subscribed to its own country.
+    """
+    def __init__(self, code):
+        self.code = code
+
+    def refresh(self):
+        pass
+
+    handler = on('state.countries.{self.code}')(refresh)
+    CountryRow = type('CountryRow', (), {'__init__': __init__, 'refresh': handler})
+
+    state.reset()
+    state.countries = {f'C{i}': {'population': 0} for i in range(5000)}
+    # Instances are only kept alive by the list, while measuring.
+    rows = [CountryRow(f'C{i}') for i in range(5000)]
+
+    def write():
+        state.countries.C5.population += 1
+
+    try:
+        return ops_per_second(write)
+    finally:
+        handler.disconnect()
+        del rows
+
+
+def benchmark_as_dict() -> float:
+    """ Conversion of a tree of 10,000 nodes to plain dicts. """
+    state.reset()
+    state.tree = deep_tree(width=2000, depth=5)
+
+    def convert():
+        return state.tree.as_dict()
+
+    return ops_per_second(convert, number=10)
+
+
+def benchmark_snapshot() -> dict:
+    """
+    Snapshot of a tree of 10,000 nodes after a change of one value, and
+    diff of the snapshots taken before and after the change.
+    """
+    state.reset()
+    state.tree = deep_tree(width=2000, depth=5)
+    state.snapshot()
+
+    def change():
+        state.tree.branch5.level0.level1.level2.level3.value += 1
+        return state.snapshot()
+
+    def diff():
+        old = state.snapshot()
+        return old.diff(change())
+
+    return {
+        'change+snapshot ops/s': ops_per_second(change, number=1000),
+        'change+diff ops/s': ops_per_second(diff, number=1000),
+    }
+
+
+def benchmark_history() -> dict:
+    """ Write to a tree of 10,000 nodes, recorded in history, and its undo. """
+    state.reset()
+    state.tree = deep_tree(width=2000, depth=5)
+    state.track_history('state.tree', limit=1000)
+
+    def write():
+        state.tree.branch5.level0.level1.level2.level3.value += 1
+
+    def write_undo():
+        write()
+        state.undo()
+
+    try:
+        return {
+            'write ops/s': ops_per_second(write),
+            'write+undo ops/s': ops_per_second(write_undo),
+        }
+    finally:
+        state.track_history(enabled=False)
+
+
+def benchmark_autopersist() -> dict:
+    """ Snapshot save and load of 50,000 countries. """
+    with TemporaryDirectory() as tmp:
+        state.reset()
+        state.autopersist(Path(tmp) / 'state', timeout=0)
+        state.countries = countries_response(50_000)
+
+        start = perf_counter()
+        state._appstate_storage.compact(state)
+        save = perf_counter() - start
+
+        state._appstate_persist.disconnect()
+        state.reset()
+        start = perf_counter()
+        state.autopersist(Path(tmp) / 'state', timeout=0)
+        load = perf_counter() - start
+
+        state._appstate_persist.disconnect()
+        state.reset()
+    return {'save s': save, 'load s': load}
+
+
+def large_state(size=10_000_000) -> dict:
+    """ Plain data state of about `size` bytes when pickled. """
+    record_size = 45  # Approximately, pickled
+    return {
+        f'branch{i}': {
+            'records': [
+                {'id': j, 'name': f'record {j}', 'score': j / 7, 'tags': ['a', 'b']}
+                for j in range(1000)
+            ]
+        }
+        for i in range(size // record_size // 1000)
+    }
+
+
+def benchmark_persist_formats() -> dict:
+    """ Save and load time, and snapshot size of a 10 MB state. """
+    state.reset()
+    state.update(large_state())
+    results = {}
+
+    for format in ['pickle', 'json', 'marshal', 'msgpack', 'pickle+zlib', 'marshal+zstd', 'msgpack+zstd']:
+        with TemporaryDirectory() as tmp:
+            try:
+                storage = Storage(Path(tmp) / 'state', format=format)
+            except ImportError as err:
+                print(f'Skipping {format}: {err}')
+                continue
+
+            start = perf_counter()
+            storage.compact(state)
+            results[f'{format} save s'] = perf_counter() - start
+            results[f'{format} size MB'] = storage.snapshot_size / 1e6
+
+            start = perf_counter()
+            Storage(Path(tmp) / 'state', format=format).load()
+            results[f'{format} load s'] = perf_counter() - start
+
+    state.reset()
+    return results
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """ Describe measurements which are worse than baseline by more than threshold. """
+    worse = []
+    for key, value in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        change = value / old - 1
+        if key.endswith('ops/s'):
+            change = -change
+        if change > threshold:
+            worse.append(f'{key}: {old:,.3f} -> {value:,.3f} ({change:+.0%} worse)')
+    return worse
+
+
+def main(argv: list[str]) -> int:
+    benchmarks = {
+        name.removeprefix('benchmark_'): func
+        for name, func in globals().items() if name.startswith('benchmark_')
+    }
+    parser = argparse.ArgumentParser(description='Benchmarks of app_state hot paths.')
+    parser.add_argument('names', nargs='*', metavar='name', help=', '.join(benchmarks))
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed regression, fraction of the baseline (default 0.2)')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error(f'unknown benchmark {name}')
+
+    results = {}
+    for name in args.names or benchmarks:
+        result = benchmarks[name]()
+        if isinstance(result, dict):
+            for metric, value in result.items():
+                print(f'{name}: {metric}: {value:,.3f}')
+                results[f'{name}: {metric}'] = value
+        else:
+            print(f'{name}: {result:,.0f} ops/s')
+            results[f'{name}: ops/s'] = result
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        worse = regressions(results, json.loads(Path(args.compare).read_text()), args.threshold)
+        for line in worse:
+            print(f'REGRESSION {line}')
+        return 1 if worse else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
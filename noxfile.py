@@ -13,4 +13,10 @@ def test(session):
 def kivy(session):
     # session.install('kivy', 'ipdb', *deps)
     session.install('kivy', *deps)
-    session.run('pytest', *session.posargs)
+    session.run('pytest', *session.posargs, env={'APP_STATE_KIVY': '1'})
+
+@nox.session
+def bench(session):
+    """ Run benchmarks: nox -s bench -- [names] [--json out.json] [--compare baseline.json] """
+    session.install(*deps)
+    session.run('python', 'bench.py', *session.posargs)
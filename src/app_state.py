@@ -1,39 +1,156 @@
 import asyncio
+import dbm
+import importlib.util
 import inspect
+import json
 import logging
+import marshal
 import os
+import pickle
 import shelve
-from collections import defaultdict, UserDict
-from collections.abc import Mapping
-from copy import copy
-from functools import update_wrapper, partial
+import sys
+import threading
+import weakref
+import zlib
+from collections import defaultdict, deque
+from collections.abc import Mapping, MutableMapping, MutableSequence
+from contextvars import ContextVar
+from functools import update_wrapper, partial, wraps
+from itertools import count
 from collections.abc import Callable, Generator, Coroutine
 from pathlib import Path
-from textwrap import shorten
+from sys import intern
+from time import perf_counter
+from typing import Any, NamedTuple
+
+# Kivy integration makes state nodes kivy Observables, which kv rules can
+# bind to. It is enabled if kivy is installed. Importing kivy is slow, so tools
+# which don't need it may set APP_STATE_KIVY=0 environment variable to skip it.
+kivy = False
+if os.environ.get('APP_STATE_KIVY') == '1' or os.environ.get('APP_STATE_KIVY') != '0' and (
+        'kivy' in sys.modules or importlib.util.find_spec('kivy') is not None):
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    try:
+        import kivy.event
+    except ImportError:
+        kivy = False
 
-import os
-os.environ.setdefault("KIVY_NO_ARGS", "1")
+from getinstance import InstanceManager
+from sniffio import current_async_library, AsyncLibraryNotFoundError
 
-try:
-    import kivy.event
-except:
-    kivy = False
 
-try:
-    import trio
-except ImportError:
-    pass
+logger = logging.getLogger(__name__)
 
-from getinstance import InstanceManager
-from lockorator.asyncio import lock_or_exit
-from sniffio import current_async_library
 
+# Global clock of state changes. Each change takes the next version.
+versions = count(1)
 
-logger = logging.getLogger(__name__)
+
+# Stack of sets, collecting paths read while evaluating computed values.
+readers: list[set[str]] = []
+
+
+class Missing:
+    """ Absent value, like previous value of a key which did not exist. """
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __bool__(self):
+        return False
+
+
+MISSING = Missing()
+
+
+def locked(method: Callable) -> Callable:
+    """
+    Decorator of node methods which change it. In thread-safe mode, hold
+    the lock of the changed top-level state branch, while the method runs.
+    """
+    def wrapper(self, *args, **kwargs):
+        if threads is None:
+            return method(self, *args, **kwargs)
+        path = self._appstate_path
+        if '.' not in path:
+            # Root node, the changed branch is its key.
+            path = f'{path}.{args[0]}'
+        with threads.lock(path):
+            return method(self, *args, **kwargs)
+    return update_wrapper(wrapper, method)
+
+
+def locked_read(method: Callable) -> Callable:
+    """
+    Decorator of node methods which read the whole node. In thread-safe
+    mode, hold the lock of its top-level state branch, so that other threads
+    don't change it meanwhile. Root node holds the locks of all branches.
+    """
+    def wrapper(self, *args, **kwargs):
+        if threads is None:
+            return method(self, *args, **kwargs)
+        path = self._appstate_path
+        if '.' in path:
+            with threads.lock(path):
+                return method(self, *args, **kwargs)
+
+        locks = [threads.lock(f'state.{key}') for key in sorted(map(str, list(self.data)))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            for lock in locks:
+                lock.release()
+    return update_wrapper(wrapper, method)
+
+
+class Change(NamedTuple):
+    """
+    State change, passed to signal handlers which have `change` or `changes`
+    parameter.
+
+    `op` is 'set' or 'delete' for a single key or list item. Changes of
+    the whole list have 'update' op, with `new` being the list. Absent
+    values are MISSING.
+
+    `wildcards` are the path segments matched by `*` and `**` of the
+    handler pattern, see PatternTrie.
+    """
+
+    path: str
+    old: Any
+    new: Any
+    op: str
+
+    wildcards = ()
+
+    @property
+    def subtree(self) -> bool:
+        """ Whether the change may affect descendants of the path. """
+        return self.op == 'update' or isinstance(self.old, (Mapping, list, ListNode)) \
+            or isinstance(self.new, (Mapping, list, ListNode))
+
+    def matched(self, wildcards: tuple) -> 'Change':
+        """ Copy of the change with segments captured by wildcards. """
+        if not wildcards:
+            return self
+        change = WildcardChange(*self)
+        change.wildcards = wildcards
+        return change
+
+
+class WildcardChange(Change):
+    """ Change with `wildcards` attribute, see Change.matched(). """
+
+
+# Signal handlers of kivy bindings, keyed by binding uid.
+kivy_bindings: dict[int, 'signal_handler'] = {}
+kivy_uids = count(1)
 
 
 if kivy:
-    class BaseDict(kivy.event.Observable, UserDict):
+    class BaseDict(kivy.event.Observable, MutableMapping):
         """
         Provides fbind() method which lets kivy.lang.Builder to
         listen to state changes.
@@ -44,35 +161,133 @@ if kivy:
             return None
 
 
-        def fbind(self, name, func, args, **kwargs):
-            """ Called by kivy lang builder to bind state node. """
-            element, key, value, rule, idmap = args
-            logger.debug(f"kivy called fbind {self._appstate_path}.{name} {rule=}")
+        def fbind(self, name, func, *largs, **kwargs):
+            """
+            Called by kivy lang builder to bind state node. Return uid of
+            the binding, for unbind_uid().
+            """
+            logger.debug(f"kivy called fbind {self._appstate_path}.{name}")
 
             @on(f"{self._appstate_path}.{name}")
             def notify_kivy():
                 # logger.debug(f"Calling {self._appstate_path}.{name}")
                 try:
-                    func(args, None, None)
+                    func(*largs, None, None)
                 except ReferenceError as err:
-                    # TODO: unbind?
-                    # on.unregister(notify_kivy)
-                    logger.warning(err)
+                    # Bound widget is gone.
+                    logger.debug(err)
+                    kivy_bindings.pop(uid, None)
+                    on.unregister(notify_kivy)
+
+            uid = next(kivy_uids)
+            notify_kivy.binding = (name, func, largs)
+            kivy_bindings[uid] = notify_kivy
+            return uid
+
+        def funbind(self, name, func, *largs, **kwargs):
+            """ Called by kivy to release the binding made with fbind(). """
+            for uid, handler in list(kivy_bindings.items()):
+                if handler.binding == (name, func, largs) \
+                        and f'{self._appstate_path}.{name}' in handler.patterns:
+                    self.unbind_uid(name, uid)
+                    return
+
+        def unbind_uid(self, name, uid):
+            """ Called by kivy to release the binding with the given uid. """
+            handler = kivy_bindings.pop(uid, None)
+            if handler:
+                on.unregister(handler)
 
 else:
-    BaseDict = UserDict
+    BaseDict = MutableMapping
+
+
+# Instance attributes of state nodes. Nodes have no __dict__, to keep huge
+# trees compact:
+#
+#   _appstate_key - key in the parent node, or the whole path if the node
+#       has no parent. Path of the node is made of keys of its ancestors.
+#   _appstate_parent - weak reference to the parent node. Detached nodes
+#       keep their parent alive by a strong reference instead: nothing
+#       else references the ancestors created by reading non-existent keys.
+#   _appstate_version - see changed_since().
+#   _appstate_attached - False for the node created by reading a
+#       non-existent key, until it is stored in the parent on first write.
+#   _appstate_private - dict of the attributes starting with underscore,
+#       allocated when the first one is set.
+#   _appstate_frozen - (version, weak reference to the immutable copy) made
+#       by freeze().
+NODE_SLOTS = (
+    '_appstate_key', '_appstate_parent', '_appstate_version',
+    '_appstate_attached', '_appstate_private', '_appstate_frozen',
+)
+
+
+def node_path(node: 'DictNode | ListNode') -> str:
+    """ Dot-separated path of the node, like 'state.countries.AU'. """
+    get = object.__getattribute__
+    segments = []
+    while node is not None:
+        segments.append(get(node, '_appstate_key'))
+        node = get(node, '_appstate_parent')
+        if type(node) is weakref.ref:
+            node = node()
+    if len(segments) == 1:
+        return segments[0]
+    return '.'.join([str(x) for x in reversed(segments)])
+
+
+def parent_of(node: 'DictNode | ListNode') -> 'DictNode | ListNode | None':
+    """ Parent of the node, see NODE_SLOTS. """
+    parent = object.__getattribute__(node, '_appstate_parent')
+    if type(parent) is weakref.ref:
+        return parent()
+    return parent
+
+
+def make_node(cls: type, key, parent: 'DictNode | ListNode | None', value, node=None) -> 'DictNode | ListNode':
+    """ Create node of class `cls`, stored in the parent under key. """
+    if node is None:
+        node = cls.__new__(cls)
+    set = object.__setattr__
+    set(node, '_appstate_key', key)
+    # Weak references to the same parent are shared by its children.
+    set(node, '_appstate_parent', None if parent is None else weakref.ref(parent))
+    set(node, '_appstate_version', next(versions))
+    set(node, '_appstate_attached', True)
+    set(node, '_appstate_private', None)
+    set(node, '_appstate_frozen', None)
+
+    # Convert nested values into canonical subnodes once, on creation.
+    # Reads then return stored subnodes without any allocation.
+    make = node._make_subnode
+    if issubclass(cls, ListNode):
+        set(node, 'data', [make(index, item) for index, item in enumerate(value)])
+    else:
+        data = {}
+        for key, item in value.items():
+            if type(key) is str:
+                # Keys repeated in many nodes are stored once.
+                key = intern(key)
+            data[key] = make(key, item)
+        set(node, 'data', data)
+    return node
 
 
 class DictNode(BaseDict):
-    def __init__(self, *args, path, **kwargs):
-        self._appstate_path = path
+    __slots__ = ('data', *NODE_SLOTS, *(() if BaseDict.__weakrefoffset__ else ('__weakref__',)))
 
-        self.data = {}
+    def __init__(self, *args, path, parent=None, **kwargs):
+        if len(args) > 1:
+            raise TypeError(f'expected at most 1 arguments, got {len(args)}')
+        key = path
+        if parent is not None:
+            key = path.rpartition('.')[2]
+            if type(parent) is ListNode:
+                key = int(key)
+        make_node(type(self), key, parent, dict(*args, **kwargs), self)
 
-        if args:
-            self.update(args[0], signal=False)
-        if kwargs:
-            self.update(kwargs, signal=False)
+    _appstate_path = property(node_path)
 
     def __reduce__(self):
         """ Persist as a regular dict """
@@ -85,8 +300,6 @@ class DictNode(BaseDict):
             return f'{" "*depth}<DictNode {self._appstate_path} {{}}>'
 
         result =  f'{" "*depth}<DictNode {self._appstate_path} {{\n'
-        if '_list' in path:
-            result = '\n' + result
         for key in self:
             if isinstance(self[key], DictNode):
                 result += f'{self[key]!r}\n'
@@ -101,130 +314,241 @@ class DictNode(BaseDict):
 
     def _make_subnode(self, key, value):
         # logger.debug(f'make {self._appstate_path}.{key} {value=} {type(value)=}')
-        if isinstance(value, DictNode):
-            # logger.debug(f'  already DictNode')
-            return value
-        if not isinstance(value, Mapping):
-            return value
-
-        return DictNode(value, path=f'{self._appstate_path}.{key}')
-
-    def __getitem__(self, name):
-        result = super().__getitem__(name)
-        if isinstance(result, list):
-            # logger.debug(f'__getitem__ {self._appstate_path}.{name}')
-            return [self._make_subnode(f'{name}._list', x) for x in result]
+        kind = type(value)
+        if kind is DictNode or kind is ListNode:
+            if parent_of(value) is self and value._appstate_key == key:
+                # logger.debug(f'  already DictNode')
+                if not value._appstate_attached:
+                    value._appstate_attached = True
+                return value
+            # Node from another branch - copy it, so that its changes signal
+            # with the correct path.
+            return make_node(kind, key, self, value.data if kind is ListNode else value)
+        if kind is dict or isinstance(value, Mapping):
+            return make_node(DictNode, key, self, value)
+        if isinstance(value, list):
+            return make_node(ListNode, key, self, value)
+
+        return value
+
+    def _appstate_touch(self):
+        """
+        Advance version of this node and of its ancestors, on change.
+        """
+        version = next(versions)
+        node = self
+        while node is not None:
+            parent = object.__getattribute__(node, '_appstate_parent')
+            if type(parent) is weakref.ref:
+                parent = parent()
+            if parent is None and threads is not None:
+                # Root is shared by branches changed in different threads.
+                with threads.root_lock:
+                    if node._appstate_version < version:
+                        object.__setattr__(node, '_appstate_version', version)
+                return
+            object.__setattr__(node, '_appstate_version', version)
+            node = parent
 
-        return self._make_subnode(name, result)
+    def _appstate_attach(self):
+        """
+        Store this detached node in the state, creating missing ancestors.
+        Happens once, on the first write to the node.
+        """
+        segments = self._appstate_path.split('.')
+        ancestor = state
+        for segment in segments[1:-1]:
+            if type(ancestor) is ListNode:
+                # Items of a list are attached by the list itself.
+                ancestor = ancestor.data[int(segment)]
+                continue
+            node = ancestor.data.get(segment)
+            if type(node) is not DictNode and type(node) is not ListNode:
+                Batch.save(ancestor, segment)
+                node = ancestor.data[segment] = ancestor._make_subnode(segment, {})
+            ancestor = node
+
+        Batch.save(ancestor, segments[-1])
+        ancestor.data[segments[-1]] = self
+        self._appstate_parent = weakref.ref(ancestor)
+        self._appstate_attached = True
+
+    def changed_since(self, version: int) -> bool:
+        """
+        Check whether this node or any of its descendants has changed since
+        the given version. Store node._appstate_version to compare later:
 
+            seen = state.countries._appstate_version
+            ...
+            if state.countries.changed_since(seen):
+                redraw()
+        """
+        return self._appstate_version > version
 
-    def get(self, key, *args, **kwargs):
+    def __getitem__(self, name):
+        if readers:
+            readers[-1].add(f'{self._appstate_path}.{name}')
+        # Subnodes are stored already converted.
+        return self.data[name]
+
+    def __iter__(self):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        if threads is not None:
+            # Other threads may change the node during iteration.
+            return iter(list(self.data))
+        return iter(self.data)
+
+    def __len__(self):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        return len(self.data)
+
+    def __contains__(self, key):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        return key in self.data
+
+
+    def get(self, key, default=None):
         # logger.debug(f'get {self._appstate_path}.{key}')
-        return self._make_subnode(key, super().get(key, *args, **kwargs))
+        try:
+            return self[key]
+        except KeyError:
+            node = self._make_subnode(key, default)
+            if type(node) is DictNode or type(node) is ListNode:
+                node._appstate_attached = False
+                node._appstate_parent = self
+            return node
 
     def __getattribute__(self, name):
         # logger.debug(f'__getattribute__ {name}')
-        if name.startswith('_') or name == 'data' or name in DictNode.__dict__  or name in dict.__dict__:
+        if name.startswith('_') or name in DICTNODE_ATTRIBUTES:
             # logger.debug(f'__getattribute__ {name} direct')
-            return super().__getattribute__(name)
+            try:
+                return object.__getattribute__(self, name)
+            except AttributeError:
+                private = object.__getattribute__(self, '_appstate_private')
+                if private is None or name not in private:
+                    raise
+                return private[name]
 
         # logger.debug(f'__getattribute__ {name}')
+        if readers:
+            readers[-1].add(f'{self._appstate_path}.{name}')
         try:
-            result = self[name]
+            result = object.__getattribute__(self, 'data')[name]
         except KeyError:
             try:
-                return super().__getattribute__(name)
+                return object.__getattribute__(self, name)
             except:
                 # Support access of non-existent chain of keys:
                 # >>> assert state.some.node.which.dont.exist == {}
 
                 # Questionable feature, but simplifies some cases
                 # especially with the limited kvlang syntax.
-                return self._make_subnode(name, {})
-
-        if isinstance(result, list):
-            # logger.debug(f'__getattribute__ {name}')
-            result = [self._make_subnode(f'{name}._list', x) for x in result]
+                node = self._make_subnode(name, {})
+                node._appstate_attached = False
+                node._appstate_parent = self
+                return node
 
         return result
 
+    @locked
     def __delitem__(self, key):
-        super().__delitem__(key)
-        on.trigger(f'{self._appstate_path}.{key}')
+        Batch.save(self, key)
+        old = self.data.pop(key)
+        self._appstate_touch()
+        path = f'{self._appstate_path}.{key}'
+        on.trigger(path, Change(path, old, MISSING, 'delete'))
 
     def update(self, *a, signal=True, **kw):
         # logger.debug(f'update {a}, {kw}')
 
-        changed = False
         if len(a) > 1:
             raise TypeError(f'update expected at most 1 arguments, got {len(a)}')
+
+        items = list(kw.items())
         if a:
             if hasattr(a[0], 'keys'):
-                for key in a[0]:
-                    if key not in self or not self[key] == a[0][key]:
-                        # logger.debug(f'update {key} {a[0][key]}')
-                        changed = True
-                        #logger.debug(key, a[0][key])
-                        self.__setitem__(key, a[0][key], signal=False)
+                items = [(key, a[0][key]) for key in a[0]] + items
             else:
-                for k, v in a[0]:
-                    if k not in self or not self[k] == v:
-                        changed = True
-                        self.__setitem__(k, v, signal=False)
-
-        for key in kw:
-            if key not in self or not self[key] == kw[key]:
-                changed = True
-                self.__setitem__(key, kw[key], signal=False)
-
-        if changed and signal:
-            on.trigger(f'{self._appstate_path}')
+                items = list(a[0]) + items
+
+        # Leaf changes are signalled together, once the update is done.
+        with Batch(signal=signal):
+            self._appstate_diff(items)
+
+    def _appstate_diff(self, items, replace=False):
+        """
+        Set only the values which differ from the given items. Descend into
+        nested mappings and lists of the same length, instead of comparing
+        and replacing whole subtrees. Values identical to the stored ones
+        are skipped without comparison.
+
+        If `replace` is True, delete keys absent in items.
+        """
+        data = self.data
+        keys = set() if replace else None
+        for key, value in items:
+            if replace:
+                keys.add(key)
+            old = data.get(key, MISSING)
+            if old is value:
+                continue
+            if type(old) is LazyBranch:
+                old = self[key]
+
+            # Exact type checks are much faster than isinstance() with ABCs.
+            kind = type(old)
+            if kind is DictNode and isinstance(value, Mapping):
+                old._appstate_diff(value.items(), replace=True)
+            elif kind is ListNode and type(value) is list and len(old.data) == len(value):
+                old._appstate_diff(value)
+            elif kind is DictNode or kind is ListNode or old is MISSING or not old == value:
+                # logger.debug(f'update {key} {value}')
+                self[key] = value
+
+        if replace:
+            for key in [x for x in data if x not in keys]:
+                del self[key]
             # logger.debug(f'UPDATE: changed {self._appstate_path}')
         # else:
         #     logger.debug(f'Not changed {self._appstate_path}')
 
 
+    @locked
     def setdefault(self, key, value):
         if key not in self:
             self[key] = value
         return self[key]
 
+    @locked
     def __setitem__(self, key, value, signal=True):
         # logger.debug(f'  __setitem__ {self._appstate_path}[{key}] = {value}')
 
-        if '_list' in self._appstate_path.split('.'):
-            node = self._make_subnode(key, value)
-            return super().__setitem__(key, node)
-
-        ancestor = state
-        for path in self._appstate_path.split('.')[1:-1]:
-            # For each my ancestor, ensure it existis in state. Create new
-            # empty node if not.
-
-            # logger.debug(f"{ancestor._appstate_path=} {path=}")
-            if path in ancestor:
-                # logger.debug(f'!!     {path} is already in {ancestor._appstate_path}')
-                if isinstance(ancestor[path], DictNode):
-                    # logger.debug(f'already exists {ancestor._appstate_path}.{path} ')
-                    ancestor = ancestor[path]
-                    continue
-                # else:
-                    # logger.debug(f"{path} exists but it's not a dict node")
-
-            # logger.debug(f'setting {ancestor._appstate_path}.{path} = {{}}')
-            ancestor.__setitem__(path, ancestor._make_subnode(path, {}), signal=False)
-            ancestor = ancestor[path]
-
-        my_name = self._appstate_path.split('.')[-1]
-        if not my_name == 'state':
-            # I am not the root (self != state). Ensure that ancestor contains myself
-            ancestor.__setitem__(my_name, self, signal=False)
+        if not self._appstate_attached:
+            self._appstate_attach()
 
         # Finally, create node from given value
-        super().__setitem__(key, self._make_subnode(key, value))
+        if type(key) is str:
+            key = intern(key)
+        old = self.data.get(key, MISSING)
+        if signal and type(old) is LazyBranch:
+            # Handlers get the value, not the placeholder of the lazy storage.
+            old = self[key]
+        node = self._make_subnode(key, value)
+        if node is old and (type(node) is DictNode or type(node) is ListNode):
+            # Node reassigned after in-place change, like `state.items += [x]`,
+            # which has signalled already.
+            return
+        Batch.save(self, key)
+        self.data[key] = node
+        self._appstate_touch()
 
         if signal:
-            on.trigger(f'{self._appstate_path}.{key}')
+            path = f'{self._appstate_path}.{key}'
+            on.trigger(path, Change(path, old, node, 'set'))
 
 
     def __setattr__(self, name, value):
@@ -235,31 +559,42 @@ class DictNode(BaseDict):
         node = self._make_subnode(name, value)
 
         if name.startswith('_'):
-            super().__setattr__(name, node)
-            on.trigger(f'{self._appstate_path}.{name}')
+            if self._appstate_private is None:
+                self._appstate_private = {}
+            old = self._appstate_private.get(name, MISSING)
+            self._appstate_private[name] = node
+            path = f'{self._appstate_path}.{name}'
+            on.trigger(path, Change(path, old, node, 'set'))
             #logger.debug(f'signal {self._appstate_path}.{name}')
         else:
             self.__setitem__(name, node)
         # logger.debug(f'END __setattr__ {self._appstate_path}.{name} = {value}')
 
 
+    def copy(self) -> dict:
+        """ Shallow copy, as a regular dict. """
+        return dict(self.data)
+
+    @locked_read
     def as_dict(self, full=False):
+        if readers:
+            readers[-1].add(self._appstate_path)
         result = {}
-        for key, val in self.items():
+        # Items are copied at once, as new keys may be added by other threads.
+        for key, val in list(self.data.items()):
+            if type(val) is LazyBranch:
+                val = self[key]
             if isinstance(val, DictNode):
                 result[key] = val.as_dict(full=full)
-            elif isinstance(val, list):
-                result[key] = [
-                    x.as_dict(full=full) if isinstance(x, DictNode) else x
-                    for x in val
-                ]
+            elif isinstance(val, ListNode):
+                result[key] = val.as_list(full=full)
             else:
                 result[key] = val
 
         if not full:
             return result
 
-        for k, v in self.__dict__.items():
+        for k, v in (self._appstate_private or {}).items():
             if not k.startswith('_appstate_') and k.startswith('_'):
                 if isinstance(v, DictNode):
                     result[k] = v.as_dict(full=full)
@@ -268,97 +603,1644 @@ class DictNode(BaseDict):
         return result
 
 
+class ListNode(MutableSequence):
+    """
+    List stored in the state. Like DictNode, it is created implicitly when
+    a list is assigned to any state branch:
+
+        state.items = [{'id': 1}]
+        state.items.append({'id': 2})  # Signals 'state.items.1'
+
+    Items are converted into subnodes once, on insertion, and are returned
+    without copying. Changing an item signals with its index in the path,
+    e.g. 'state.items.3'. Changes which shift items (insert, pop from the
+    middle, sort, etc) signal the whole list.
+    """
+
+    __slots__ = ('data', *NODE_SLOTS, '__weakref__')
+
+    def __init__(self, items=(), *, path, parent=None):
+        key = path
+        if parent is not None:
+            key = path.rpartition('.')[2]
+            if type(parent) is ListNode:
+                key = int(key)
+        make_node(type(self), key, parent, list(items), self)
+
+    _appstate_path = property(node_path)
+    _make_subnode = DictNode._make_subnode
+    _appstate_touch = DictNode._appstate_touch
+    changed_since = DictNode.changed_since
+
+    def __reduce__(self):
+        """ Persist as a regular list """
+        return (list, (self.data,))
+
+    def _reindex(self, start=0):
+        """ Update keys of items, shifted to a new position. """
+        for index in range(start, len(self.data)):
+            item = self.data[index]
+            if isinstance(item, (DictNode, ListNode)):
+                object.__setattr__(item, '_appstate_key', index)
+
+    def _appstate_diff(self, values):
+        """ Set only the items which differ. See DictNode._appstate_diff(). """
+        for index, value in enumerate(values):
+            old = self.data[index]
+            if old is value:
+                continue
+
+            kind = type(old)
+            if kind is DictNode and isinstance(value, Mapping):
+                old._appstate_diff(value.items(), replace=True)
+            elif kind is ListNode and type(value) is list and len(old.data) == len(value):
+                old._appstate_diff(value)
+            elif kind is DictNode or kind is ListNode or not old == value:
+                self[index] = value
+
+    def _changed(self, index=None, old=MISSING, new=MISSING):
+        """
+        Signal change of the item at index, or of the whole list if index
+        is None.
+        """
+        self._appstate_touch()
+        if index is None:
+            path = self._appstate_path
+            return on.trigger(path, Change(path, MISSING, self, 'update'))
+
+        path = f'{self._appstate_path}.{index}'
+        on.trigger(path, Change(path, old, new, 'delete' if new is MISSING else 'set'))
+
+    def __getitem__(self, index):
+        if readers:
+            if isinstance(index, slice):
+                readers[-1].add(self._appstate_path)
+            else:
+                readers[-1].add(f'{self._appstate_path}.{range(len(self.data))[index]}')
+        # Slices are returned as plain lists of stored items.
+        return self.data[index]
+
+    def __iter__(self):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        if threads is not None:
+            # Other threads may change the node during iteration.
+            return iter(list(self.data))
+        return iter(self.data)
+
+    def __len__(self):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        return len(self.data)
+
+    def __contains__(self, item):
+        if readers:
+            readers[-1].add(self._appstate_path)
+        return item in self.data
+
+    @locked
+    def __setitem__(self, index, value):
+        Batch.save(self, None)
+        if not isinstance(index, slice):
+            index = range(len(self.data))[index]
+            old = self.data[index]
+            self.data[index] = self._make_subnode(index, value)
+            return self._changed(index, old, self.data[index])
+
+        start, stop, step = index.indices(len(self.data))
+        if step == 1:
+            items = [self._make_subnode(start + i, x) for i, x in enumerate(value)]
+            self.data[start:max(start, stop)] = items
+            self._reindex(start + len(items))
+        else:
+            positions = range(start, stop, step)
+            self.data[index] = [
+                self._make_subnode(i, x) for i, x in zip(positions, value, strict=True)
+            ]
+        self._changed()
+
+    @locked
+    def __delitem__(self, index):
+        Batch.save(self, None)
+        if isinstance(index, slice):
+            del self.data[index]
+            self._reindex()
+            return self._changed()
+
+        index = range(len(self.data))[index]
+        old = self.data.pop(index)
+        if index == len(self.data):
+            # Last item removed, no shift.
+            return self._changed(index, old)
+        self._reindex(index)
+        self._changed()
+
+    @locked
+    def append(self, item):
+        Batch.save(self, None)
+        index = len(self.data)
+        self.data.append(self._make_subnode(index, item))
+        self._changed(index, new=self.data[index])
+
+    @locked
+    def extend(self, items):
+        Batch.save(self, None)
+        start = len(self.data)
+        for item in items:
+            self.data.append(self._make_subnode(len(self.data), item))
+        if len(self.data) - start == 1:
+            self._changed(start, new=self.data[start])
+        elif len(self.data) > start:
+            self._changed()
+
+    @locked
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    @locked
+    def __imul__(self, n):
+        self[:] = self.data * n
+        return self
+
+    @locked
+    def insert(self, index, item):
+        Batch.save(self, None)
+        size = len(self.data)
+        if index < 0:
+            index = max(0, size + index)
+        index = min(index, size)
+        self.data.insert(index, self._make_subnode(index, item))
+        if index == len(self.data) - 1:
+            return self._changed(index, new=self.data[index])
+        self._reindex(index + 1)
+        self._changed()
+
+    @locked
+    def pop(self, index=-1):
+        item = self.data[index]
+        del self[index]
+        return item
+
+    @locked
+    def remove(self, item):
+        del self[self.data.index(item)]
+
+    @locked
+    def clear(self):
+        Batch.save(self, None)
+        self.data.clear()
+        self._changed()
+
+    @locked
+    def sort(self, /, *args, **kwargs):
+        Batch.save(self, None)
+        self.data.sort(*args, **kwargs)
+        self._reindex()
+        self._changed()
+
+    @locked
+    def reverse(self):
+        Batch.save(self, None)
+        self.data.reverse()
+        self._reindex()
+        self._changed()
+
+    def __repr__(self):
+        return repr(self.data)
+
+    def __eq__(self, other):
+        return self.data == (other.data if isinstance(other, ListNode) else other)
+
+    def __lt__(self, other):
+        return self.data < (other.data if isinstance(other, ListNode) else other)
+
+    def __le__(self, other):
+        return self.data <= (other.data if isinstance(other, ListNode) else other)
+
+    def __gt__(self, other):
+        return self.data > (other.data if isinstance(other, ListNode) else other)
+
+    def __ge__(self, other):
+        return self.data >= (other.data if isinstance(other, ListNode) else other)
+
+    def count(self, item):
+        return self.data.count(item)
+
+    def index(self, item, *args):
+        return self.data.index(item, *args)
+
+    def copy(self):
+        return list(self.data)
+
+    def __add__(self, other):
+        return self.data + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.data
+
+    def __mul__(self, n):
+        return self.data * n
+
+    __rmul__ = __mul__
+
+    @locked_read
+    def as_list(self, full=False):
+        return [
+            x.as_dict(full=full) if isinstance(x, DictNode)
+            else x.as_list(full=full) if isinstance(x, ListNode)
+            else x
+            for x in self.data
+        ]
+
+
+# Names which DictNode.__getattribute__ resolves as attributes, not as keys.
+DICTNODE_ATTRIBUTES = frozenset({'data', *dir(DictNode)})
+
+
 class State(DictNode):
     """
     Root node, singleton.
     """
 
+    def __getitem__(self, name):
+        result = super().__getitem__(name)
+        if type(result) is LazyBranch:
+            return self._appstate_materialize(name, result)
+        return result
+
+    def __getattribute__(self, name):
+        result = super().__getattribute__(name)
+        if type(result) is LazyBranch:
+            return self._appstate_materialize(name, result)
+        return result
+
+    def _appstate_materialize(self, key, branch: 'LazyBranch'):
+        """ Deserialize lazily loaded branch, on first access. """
+        # logger.debug(f'Materializing state.{key}')
+        node = self.data[key] = self._make_subnode(key, branch.load())
+        return node
+
     def reset(self):
         for key in list(self.keys()):
             super().__delitem__(key)
 
 
-    def autopersist(self, filename: str | Path, timeout=3, nursery=None):
-        self._appstate_shelve = shelve.open(str(filename))
+    def snapshot(self) -> 'Snapshot':
+        """
+        Immutable copy of the whole state, safe to read from other threads.
+        Subtrees unchanged since the previous snapshot are shared with it,
+        so taking a snapshot costs in proportion to the changes made since,
+        and snapshots are compared with Snapshot.diff() quickly.
+
+        The last snapshot is kept, so that its unchanged subtrees are shared
+        with the next one even if the caller has dropped it.
+        """
+        # Changes made in other threads wait until the copy is done.
+        snapshot = locked_read(freeze)(self)
+        self._appstate_snapshot = snapshot
+        return snapshot
+
+
+    def track_history(
+        self,
+        *paths: str,
+        limit: int = 100,
+        max_values: int = 100_000,
+        enabled: bool = True,
+    ) -> 'History | None':
+        """
+        Record changes under the given paths (whole state by default), to
+        be reverted with state.undo() and repeated with state.redo(). Keep
+        at most `limit` entries and `max_values` values, see History.
+        Stop recording and discard the history if `enabled` is False.
+        """
+        global history
+        history = History(paths or ('state',), limit, max_values) if enabled else None
+        return history
+
+
+    def undo(self) -> bool:
+        """
+        Revert the last change, or all changes of the last batch. Return
+        False if there is nothing to undo.
+        """
+        return history is not None and history.undo()
+
+
+    def redo(self) -> bool:
+        """ Repeat the last undone change. Return False if there is nothing to redo. """
+        return history is not None and history.redo()
+
+
+    def batch(self, rollback: bool = False) -> 'Batch':
+        """
+        Group state changes, delivering signals once after the batch exits:
+
+            with state.batch():
+                state.user.name = 'Alice'
+                state.user.age = 30
+        """
+        return Batch(rollback=rollback)
+
+
+    def transaction(self) -> 'Batch':
+        """ Batch which reverts its changes if an exception is raised. """
+        return Batch(rollback=True)
+
+
+    def threadsafe(self, dispatcher: Callable[[Callable], Any] | None = None):
+        """
+        Allow changing the state from other threads. Changes are serialized
+        by the lock of each top-level branch, which as_dict() and as_list()
+        hold too. Iterating a node copies its keys first. Other reads may
+        see changes made meanwhile, use snapshot() for a consistent copy
+        of the whole state. Signal handlers are called in
+        the current thread: changes made in other threads are queued, and
+        delivered by a call scheduled with `dispatcher(callable)`.
+
+        By default, the call is scheduled in the running asyncio or trio
+        event loop, or with the kivy Clock.
+        """
+        global threads
+
+        if dispatcher is None:
+            library = running_async_library()
+            if library == 'trio':
+                import trio
+                dispatcher = trio.lowlevel.current_trio_token().run_sync_soon
+            elif library == 'asyncio':
+                dispatcher = asyncio.get_running_loop().call_soon_threadsafe
+            elif 'kivy' in sys.modules:
+                from kivy.clock import Clock
+                dispatcher = lambda callable: Clock.schedule_once(lambda dt: callable())
+            else:
+                raise RuntimeError('No event loop is running, provide the dispatcher.')
+
+        threads = ThreadSafety(dispatcher)
+
+
+    def autopersist(
+        self,
+        filename: str | Path,
+        timeout=3,
+        nursery=None,
+        depth=1,
+        lazy=False,
+        format: 'str | Codec' = 'pickle',
+    ):
+        global persisted
+
+        if getattr(self, '_appstate_persist', None):
+            # Stop previous autopersist.
+            self._appstate_persist.disconnect()
+            persisted = None
+
+        self._appstate_storage = Storage(filename, depth=depth, lazy=lazy, format=format)
+        if self.data:
+            # Keys set before autopersist() are not in the storage yet.
+            self._appstate_storage.full = True
 
         # logger.debug(f'Starting autopersist')
 
-        for k, v in self._appstate_shelve.get('state', {}).items():
+        for k, v in self._appstate_storage.load().items():
             # logger.debug(f'loading from storage {k=} {v=}')
             self.__setitem__(k, v, signal=False)
 
         # logger.debug(f'Finished loading from storage')
         on.trigger('state')
 
+        # Changed subtrees are marked dirty by Batch.save(), before every change,
+        # including the changes made with signal=False.
+        persisted = self._appstate_storage
+
         @on('state')
         def persist():
             if timeout == 0:
-                logger.debug('Saving state:\n{items}'.format(items="\n".join(
-                    f'{key}: {shorten(str(value), 60)}' for key, value in state.items()
-                )))
-                state._appstate_shelve['state'] = state.as_dict()
-                state._appstate_shelve.sync()
+                state._appstate_storage.flush(state)
                 return
 
-            try:
-                asynclib = current_async_library()
-            except:
-                state._appstate_shelve['state'] = state.as_dict()
-                state._appstate_shelve.sync()
+            asynclib = running_async_library()
+            if asynclib is None:
+                state._appstate_storage.flush(state)
+            elif asynclib == 'trio':
+                #if not nursery:
+                nursery = getattr(state, '_nursery')
+                if not nursery:
+                    raise Exception('Provide nursery for state persistence task to run in.')
+                nursery.start_soon(persist_delayed, timeout)
             else:
-                if asynclib == 'trio':
-                    #if not nursery:
-                    nursery = getattr(state, '_nursery')
-                    if not nursery:
-                        raise Exception('Provide nursery for state persistence task to run in.')
-                    nursery.start_soon(persist_delayed, timeout)
-                else:
-                    asyncio.create_task(persist_delayed(timeout))
+                asyncio.create_task(persist_delayed(timeout))
 
+        self._appstate_persist = persist
 
-    def reload(self, filename: str | Path):
-        if self._appstate_shelve:
-            self._appstate_shelve.close()
 
-        self._appstate_shelve = shelve.open(str(filename))
+    def reload(self, filename: str | Path):
+        global persisted
+        active = persisted is not None
+        persisted = None
+
+        storage = getattr(self, '_appstate_storage', None)
+        self._appstate_storage = Storage(
+            filename,
+            depth=storage.depth if storage else 1,
+            lazy=storage.lazy if storage else False,
+            format=storage.codec if storage else 'pickle',
+        )
 
         # logger.debug(f'Starting reload')
 
-        for k, v in self._appstate_shelve.get('state', {}).items():
+        for k, v in self._appstate_storage.load().items():
             # logger.debug(f'loading from storage {k=} {v=}')
             self.__setitem__(k, v, signal=False)
 
         # logger.debug(f'Finished loading from storage')
         on.trigger('state')
+        if active:
+            persisted = self._appstate_storage
+
+
+# Codec classes by name, registered when defined.
+codecs: dict[str, type['Codec']] = {}
+
+
+class Codec:
+    """
+    Serialization format of the persisted state. Subclass it and pass an
+    instance to state.autopersist(format=...) to plug in a custom format.
+    Subclasses with `name` class attribute are registered, so that files
+    written with them are read after switching to another format.
+
+    Values to serialize are plain dicts, lists and leaf values of the state.
+    """
+
+    # Stored in the snapshot, to read files written with another format.
+    name: str
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'name' in cls.__dict__:
+            codecs.setdefault(cls.name, cls)
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, blob: bytes):
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """ Supports any picklable leaf values. Default. """
+
+    name = 'pickle'
+
+    def dumps(self, value) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, blob: bytes):
+        return pickle.loads(blob)
+
+
+class JsonCodec(Codec):
+    """ Portable and human readable. Keys are converted to strings. """
+
+    name = 'json'
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
+
+    def loads(self, blob: bytes):
+        return json.loads(blob)
+
+
+class MarshalCodec(Codec):
+    """
+    Fastest for plain data. Supports only builtin types, and its format may
+    change between python versions.
+    """
+
+    name = 'marshal'
+
+    def dumps(self, value) -> bytes:
+        return marshal.dumps(value)
+
+    def loads(self, blob: bytes):
+        return marshal.loads(blob)
+
+
+class MsgpackCodec(Codec):
+    """ Compact and fast. Requires `msgpack` package. """
+
+    name = 'msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value) -> bytes:
+        return self.msgpack.packb(value)
+
+    def loads(self, blob: bytes):
+        return self.msgpack.unpackb(blob, strict_map_key=False)
+
+
+class CompressedCodec(Codec):
+    """
+    Compress output of another codec with `zlib`, or with `zstd`, which
+    requires `zstandard` package.
+    """
+
+    def __init__(self, codec: Codec, compression: str):
+        self.codec = codec
+        self.name = f'{codec.name}+{compression}'
+
+        if compression == 'zlib':
+            self.compress, self.decompress = zlib.compress, zlib.decompress
+        elif compression == 'zstd':
+            import zstandard
+            self.compress = zstandard.ZstdCompressor().compress
+            self.decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            raise ValueError(f'Unknown compression: {compression}')
+
+    def dumps(self, value) -> bytes:
+        return self.compress(self.codec.dumps(value))
+
+    def loads(self, blob: bytes):
+        return self.codec.loads(self.decompress(blob))
+
+
+def get_codec(format: 'str | Codec') -> Codec:
+    """
+    Return codec for the format name like 'json', or with compression,
+    like 'json+zstd'.
+    """
+    if isinstance(format, Codec):
+        return format
+
+    name, _, compression = format.partition('+')
+    if name not in codecs:
+        raise ValueError(f'Unknown format: {format}')
+    if compression:
+        return CompressedCodec(codecs[name](), compression)
+    return codecs[name]()
+
+
+class Storage:
+    """
+    Persistent storage of the state, used by state.autopersist().
+
+    Consists of a snapshot file `<filename>.snapshot` with the whole state,
+    and an append-only journal `<filename>.journal`. Keys of changed nodes
+    are marked dirty before each change, and flush() appends to the journal
+    only the values of dirty subtrees, cut to `depth` keys below the root. When the
+    journal grows larger than the snapshot (and than `compact_size` bytes),
+    it is compacted: the whole state is written to a new snapshot.
+
+    Each top-level branch is serialized separately with the `format` codec,
+    both in the snapshot and in the journal. With `lazy` enabled, load() returns LazyBranch
+    placeholders, deserialized by the State on first access. Branches never
+    accessed are written back to new snapshots as they are.
+
+    Snapshot is never modified in place: the new one is written to a
+    temporary file which then atomically replaces the old one. Both files
+    carry a generation number, so that a journal left over from a crash
+    during compaction is ignored. A journal record torn by a crash is
+    discarded on load.
+
+    A legacy shelve file at `filename`, written by previous versions, is
+    loaded if no snapshot exists. Files written with another format are
+    loaded, and rewritten with the new format on the first flush.
+    """
+
+    def __init__(
+        self,
+        filename: str | Path,
+        depth: int = 1,
+        lazy: bool = False,
+        format: str | Codec = 'pickle',
+        compact_size: int = 1 << 20
+    ):
+        self.filename = Path(filename)
+        self.snapshot = Path(f'{filename}.snapshot')
+        self.journal = Path(f'{filename}.journal')
+        self.depth = depth
+        self.lazy = lazy
+        self.codec = get_codec(format)
+        self.compact_size = compact_size
+
+        self.generation = 0
+        self.snapshot_size = 0
+        self.journal_size = 0
+
+        # Keys (tuples of keys below the root) of changed subtrees. Marked
+        # by any thread, swapped under the lock by flush().
+        self.dirty: set[tuple] = set()
+        self.lock = threading.Lock()
+
+        # Whole state must be written on the next flush.
+        self.full = False
+
+    def load(self) -> dict:
+        """
+        Read snapshot and replay journal over it. Return top-level branches,
+        deserialized, or as LazyBranch if storage is lazy.
+        """
+        branches = {}
+        if self.snapshot.exists():
+            with open(self.snapshot, 'rb') as f:
+                snapshot = pickle.load(f)
+            self.generation = snapshot['generation']
+            self.snapshot_size = self.snapshot.stat().st_size
+            codec = self.codec
+            if snapshot['format'] != codec.name:
+                try:
+                    codec = get_codec(snapshot['format'])
+                except ValueError:
+                    # Unregistered custom codec, maybe renamed one.
+                    logger.warning(f'Unknown format {snapshot["format"]}, reading as {codec.name}')
+                self.full = True
+            for key, blob in snapshot['state'].items():
+                branches[key] = LazyBranch(codec.loads, blob)
+        elif dbm.whichdb(str(self.filename)):
+            codec = self.codec
+            with shelve.open(str(self.filename), 'r') as legacy:
+                for key, value in legacy.get('state', {}).items():
+                    branches[key] = LazyBranch(codec.loads, codec.dumps(value))
+            self.full = True
+        else:
+            codec = self.codec
+
+        offset = self.replay(branches, codec)
+        if offset:
+            # Drop torn record, if any.
+            with open(self.journal, 'r+b') as f:
+                f.truncate(offset)
+            self.journal_size = offset
+        else:
+            self.start_journal()
+
+        if self.lazy:
+            return branches
+        return {key: branch.load() for key, branch in branches.items()}
+
+    def replay(self, branches: dict[str, 'LazyBranch'], codec: Codec) -> int:
+        """
+        Apply journal records of the current generation to branches. Return
+        offset of the end of the last valid record, or 0 if there is no
+        valid journal.
+        """
+        if not self.journal.exists():
+            return 0
+
+        offset = 0
+        with open(self.journal, 'rb') as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                return 0
+            if header != ('generation', self.generation):
+                # Stale journal, compacted into snapshot already.
+                return 0
+            offset = f.tell()
+
+            while True:
+                try:
+                    op, key, *blob = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception as err:
+                    logger.warning(f'Discarding damaged journal record: {err!r}')
+                    break
+
+                if len(key) == 1:
+                    if op == 'set':
+                        branches[key[0]] = LazyBranch(codec.loads, blob[0])
+                    else:
+                        branches.pop(key[0], None)
+                elif key[0] in branches or op == 'set':
+                    # Deeper change is applied when the branch is loaded.
+                    branch = branches.setdefault(key[0], LazyBranch(codec.loads))
+                    branch.patches.append((op, key[1:], *blob))
+                offset = f.tell()
+        return offset
+
+    def start_journal(self) -> None:
+        """ Write empty journal of the current generation. """
+        with open(self.journal, 'wb') as f:
+            pickle.dump(('generation', self.generation), f)
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+
+    def save(self, node: 'DictNode | ListNode', key) -> None:
+        """
+        Called by Batch.save() before the key of the node (or any item of
+        the list, if key is None) is changed. Mark the subtree dirty.
+        """
+        keys = [] if key is None else [key]
+        get = object.__getattribute__
+        while True:
+            parent = get(node, '_appstate_parent')
+            if type(parent) is weakref.ref:
+                parent = parent()
+            if parent is None:
+                break
+            keys.append(get(node, '_appstate_key'))
+            node = parent
+        keys.reverse()
+        self.mark_dirty(tuple(keys))
+
+    def mark_dirty(self, key: tuple) -> None:
+        """ Mark subtree containing the changed key (tuple of keys below the root) as dirty. """
+        if not key:
+            self.full = True
+            return
+        for index, segment in enumerate(key[:self.depth]):
+            if type(segment) is str and segment.startswith('_'):
+                # Attributes starting with underscore are not persisted.
+                key = key[:index]
+                break
+        if key:
+            with self.lock:
+                self.dirty.add(key[:self.depth])
+
+    def flush(self, state: 'State') -> None:
+        """ Write dirty subtrees to the journal. """
+        if self.full:
+            return self.compact(state)
+        if not self.dirty:
+            return
+
+        start = perf_counter()
+        # Keys marked by other threads from now on are left for the next flush.
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        records = []
+        written = None
+        # Ancestors sort before descendants. Keys may be of different types.
+        for key in sorted(dirty, key=lambda key: [str(x) for x in key]):
+            if written and key[:len(written)] == written:
+                # Ancestor subtree is written already.
+                continue
+            written = key
+            if threads is None:
+                records.append(self.record(state, key))
+            else:
+                with threads.lock(f'state.{key[0]}'):
+                    records.append(self.record(state, key))
+
+        logger.debug(f'Saving state: {", ".join(".".join(map(str, x[1])) for x in records)}')
+        with open(self.journal, 'ab') as f:
+            size = f.tell()
+            for record in records:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+        if profiler is not None:
+            profiler.flush('journal', self.journal_size - size, start)
+
+        if self.journal_size > max(self.compact_size, self.snapshot_size):
+            self.compact(state)
+
+    def record(self, state: 'State', key: tuple) -> tuple:
+        """ Journal record with the current value of the subtree. """
+        node = state
+        for index, segment in enumerate(key):
+            if isinstance(node, ListNode):
+                # Lists are written as a whole.
+                key = key[:index]
+                break
+            if not isinstance(node, DictNode) or segment not in node.data:
+                if index == 0:
+                    return ('del', key[:1])
+                # Deleted or replaced by a leaf - write the enclosing branch.
+                key = key[:index]
+                break
+            node = node[segment]
+
+        return ('set', key, self.codec.dumps(plain(node)))
+
+    def compact(self, state: 'State') -> None:
+        """ Write whole state to a new snapshot, and start a new journal. """
+        start = perf_counter()
+        generation = self.generation + 1
+        logger.debug(f'Saving state snapshot {generation}')
+
+        def serialize(state: 'State') -> dict:
+            # Branches are locked, changes made from now on go to the new journal.
+            with self.lock:
+                self.dirty = set()
+                self.full = False
+            branches = {}
+            for key, value in list(state.data.items()):
+                if type(value) is LazyBranch and not value.patches \
+                        and value.loads == self.codec.loads:
+                    # Never accessed, no need to serialize again.
+                    branches[key] = value.blob
+                elif type(value) is LazyBranch:
+                    branches[key] = self.codec.dumps(value.load())
+                else:
+                    branches[key] = self.codec.dumps(plain(value))
+            return branches
+
+        branches = locked_read(serialize)(state)
+
+        temp = Path(f'{self.snapshot}.tmp')
+        with open(temp, 'wb') as f:
+            pickle.dump(
+                {'generation': generation, 'format': self.codec.name, 'state': branches},
+                f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+            f.flush()
+            os.fsync(f.fileno())
+            self.snapshot_size = f.tell()
+        os.replace(temp, self.snapshot)
+        if profiler is not None:
+            profiler.flush('snapshot', self.snapshot_size, start)
+
+        self.generation = generation
+        self.start_journal()
+
+
+class LazyBranch:
+    """
+    Top-level state branch loaded from the storage, but not deserialized
+    yet. Keeps journal changes of its subtrees as patches, to be applied
+    when the branch is loaded.
+    """
+
+    def __init__(self, loads: Callable, blob: bytes | None = None):
+        self.loads = loads
+        self.blob = blob
+        self.patches: list[tuple] = []
+
+    def load(self):
+        value = {} if self.blob is None else self.loads(self.blob)
+        for op, key, *blob in self.patches:
+            if not isinstance(value, dict):
+                value = {}
+            parent = value
+            for segment in key[:-1]:
+                if not isinstance(parent.get(segment), dict):
+                    parent[segment] = {}
+                parent = parent[segment]
+            if op == 'set':
+                parent[key[-1]] = self.loads(blob[0])
+            else:
+                parent.pop(key[-1], None)
+        return value
+
+
+def plain(value):
+    """ Convert DictNode or ListNode to a regular dict or list. """
+    if isinstance(value, DictNode):
+        return value.as_dict()
+    if isinstance(value, ListNode):
+        return value.as_list()
+    return value
+
+
+class Snapshot(Mapping):
+    """
+    Immutable copy of a state branch, returned by State.snapshot(). Keys
+    are accessible as attributes too, lists are copied as FrozenList.
+
+    Copies of the subtrees unchanged between snapshots are shared, so
+    diff() skips them by identity.
+    """
+
+    __slots__ = ('data', '__weakref__')
+
+    def __init__(self, data: dict):
+        object.__setattr__(self, 'data', data)
+
+    def __setattr__(self, name, value):
+        raise TypeError('Snapshot is read-only')
+
+    def __getattr__(self, name):
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __repr__(self):
+        return f'Snapshot({self.data!r})'
+
+    def __reduce__(self):
+        return (Snapshot, (self.data,))
+
+    def as_dict(self) -> dict:
+        """ Convert to regular dicts and lists. """
+        return thaw(self)
+
+    def diff(self, other: 'Snapshot', path: str = 'state') -> list[Change]:
+        """
+        Changes turning this snapshot into the other one. Shared subtrees
+        are skipped, so the time is proportional to the size of the change.
+        """
+        changes = []
+        stack = [(path, self, other)]
+        while stack:
+            path, old, new = stack.pop()
+            for key in old.data.keys() - new.data.keys():
+                changes.append(Change(f'{path}.{key}', old.data[key], MISSING, 'delete'))
+            for key, value in new.data.items():
+                previous = old.data.get(key, MISSING)
+                if previous is value:
+                    continue
+                if type(previous) is Snapshot and type(value) is Snapshot:
+                    stack.append((f'{path}.{key}', previous, value))
+                elif type(previous) is FrozenList and type(value) is FrozenList \
+                        and len(previous) == len(value):
+                    stack.append((f'{path}.{key}', Snapshot(dict(enumerate(previous))),
+                                  Snapshot(dict(enumerate(value)))))
+                elif not (previous == value):
+                    changes.append(Change(f'{path}.{key}', previous, value, 'set'))
+        return changes
+
+
+class FrozenList(tuple):
+    """ Immutable copy of a ListNode, in a Snapshot. """
+
+    __slots__ = ()
+
+
+def freeze(node: 'DictNode | ListNode'):
+    """
+    Immutable copy of the node. Copy of a dict is reused while the node
+    version is unchanged and some snapshot still holds it, so that unchanged
+    subtrees are not copied again. Tuples can't be weakly referenced, so
+    lists are copied every time, sharing the copies of their items.
+    """
+    if type(node) is ListNode:
+        return FrozenList(
+            freeze(x) if type(x) is DictNode or type(x) is ListNode else x
+            for x in node.data
+        )
+
+    get = object.__getattribute__
+    frozen = get(node, '_appstate_frozen')
+    version = get(node, '_appstate_version')
+    if frozen is not None and frozen[0] == version:
+        copy = frozen[1]()
+        if copy is not None:
+            return copy
+
+    data = {}
+    # Items are copied at once, as new keys may be added by other threads.
+    for key, value in list(node.data.items()):
+        if type(value) is LazyBranch:
+            value = node[key]
+        data[key] = freeze(value) if type(value) is DictNode or type(value) is ListNode else value
+    copy = Snapshot(data)
+    object.__setattr__(node, '_appstate_frozen', (version, weakref.ref(copy)))
+    return copy
+
+
+def thaw(value):
+    """ Convert Snapshot or FrozenList to regular dicts and lists. """
+    if type(value) is Snapshot:
+        return {key: thaw(x) for key, x in value.data.items()}
+    if type(value) is FrozenList:
+        return [thaw(x) for x in value]
+    return value
+
+
+current_batch: ContextVar['Batch | None'] = ContextVar('current_batch', default=None)
+
+
+class Batch:
+    """
+    Context manager grouping state changes together. Returned by
+    state.batch() and state.transaction().
+
+    While a batch is active, on.trigger() only records changes. When the
+    outermost batch exits, every signal handler matching any of the
+    recorded paths is delivered exactly once, with the list of its changes. Nested batches are flattened
+    into the outer one.
+
+    If `rollback` is True and an exception is raised inside the batch,
+    values touched within it are restored, and no signals are emitted for
+    them. If `signal` is False, changes made within the batch are not
+    signalled at all.
+
+    Can be used both with `with` and `async with`. Active batch is kept in
+    a context variable, so concurrent asyncio tasks don't share batches.
+    """
+
+    def __init__(self, rollback: bool = False, signal: bool = True):
+        self.rollback = rollback
+        self.signal = signal
+        self.outer: Batch | None = None
+        self.closed = False
+
+        self.changes: list[Change] = []
+
+        # Values before the change, keyed by (id(node), key).
+        self.saved: dict[tuple, tuple[DictNode, object, object]] = {}
+
+    def __enter__(self) -> 'Batch':
+        outer = current_batch.get()
+        if outer is not None and not outer.closed:
+            # Tasks started within a batch inherit it, even after it exits.
+            self.outer = outer
+        self.token = current_batch.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        current_batch.reset(self.token)
+        self.closed = True
+
+        if exc_type and self.rollback:
+            self.restore()
+        elif not self.signal:
+            pass
+        elif self.outer:
+            self.outer.changes.extend(self.changes)
+        else:
+            self.flush()
+
+        if history is not None and not self.outer:
+            # Changes of the outermost batch are undone together.
+            history.commit()
+
+    async def __aenter__(self) -> 'Batch':
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return self.__exit__(exc_type, exc, tb)
+
+    @staticmethod
+    def save(node: 'DictNode | ListNode', key) -> None:
+        """
+        Called by DictNode before changing the key, or by ListNode before
+        changing any item (with key None). Remember previous value
+        in every active batch which can be rolled back.
+        """
+        if history is not None:
+            history.save(node, key)
+        if persisted is not None:
+            persisted.save(node, key)
+        batch = current_batch.get()
+        while batch and not batch.closed:
+            if batch.rollback and (id(node), key) not in batch.saved:
+                if isinstance(node, ListNode):
+                    # Lists are saved as a whole.
+                    batch.saved[id(node), key] = (node, key, list(node.data))
+                else:
+                    batch.saved[id(node), key] = (node, key, node.data.get(key, MISSING))
+            batch = batch.outer
+
+    def restore(self) -> None:
+        """ Revert values changed within this batch, without signals. """
+        for node, key, value in reversed(self.saved.values()):
+            if isinstance(node, ListNode):
+                node.data[:] = value
+                node._reindex()
+            elif value is MISSING:
+                node.data.pop(key, None)
+            else:
+                node.data[key] = value
+            node._appstate_touch()
+
+    def flush(self) -> None:
+        """ Deliver each handler matching recorded paths once. """
+        if threads is not None and threading.get_ident() != threads.thread:
+            return threads.submit(self.changes)
+
+        matches = {}
+        handlers = defaultdict(list)
+        for change in self.changes:
+            key = (change.path, change.subtree)
+            if key not in matches:
+                matches[key] = {}
+                for handler, wildcards in on.matches(*key):
+                    matches[key].setdefault(handler, wildcards)
+                if profiler is not None:
+                    profiler.trigger(change.path, len(matches[key]))
+            for handler, wildcards in matches[key].items():
+                handlers[handler].append(change.matched(wildcards))
+
+        for handler in sorted(handlers, key=delivery_order):
+            handler.deliver(handlers[handler])
+
+
+class ThreadSafety:
+    """
+    State of the thread-safe mode, enabled by state.threadsafe().
+
+    Changes of each top-level state branch are serialized by its own lock.
+    Signals of the changes made in other threads are queued, and delivered
+    in the thread which enabled the mode, by a single call scheduled with
+    `dispatcher` for all changes queued meanwhile.
+    """
+
+    def __init__(self, dispatcher: Callable[[Callable], Any]):
+        self.dispatcher = dispatcher
+        self.thread = threading.get_ident()
+        self.locks: dict[str, threading.RLock] = {}
+        self.root_lock = threading.Lock()
+
+        self.queue_lock = threading.Lock()
+        self.queue: list[Change] = []
+        self.scheduled = False
+
+    def lock(self, path: str) -> threading.RLock:
+        """ Lock of the top-level branch containing the given path. """
+        branch = path.split('.', 2)[1]
+        try:
+            return self.locks[branch]
+        except KeyError:
+            return self.locks.setdefault(branch, threading.RLock())
+
+    def submit(self, changes: list[Change]) -> None:
+        """ Queue changes made in another thread, to be delivered. """
+        with self.queue_lock:
+            self.queue.extend(changes)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.dispatcher(self.deliver)
+
+    def deliver(self) -> None:
+        """ Deliver queued changes. Called in the thread owning the state. """
+        with self.queue_lock:
+            changes, self.queue = self.queue, []
+            self.scheduled = False
+        batch = Batch()
+        batch.changes = changes
+        batch.flush()
+
+
+# Enabled by state.threadsafe()
+threads: ThreadSafety | None = None
+
+
+class History:
+    """
+    Undo/redo history of the state changes under the given paths, enabled
+    by state.track_history().
+
+    Batch.save() records the previous value of every changed key. Changes
+    are grouped into entries: all changes made within the outermost batch
+    or transaction, or a single change made outside of batches. Values are
+    recorded by reference, so unchanged subtrees are never copied.
+
+    Oldest entries are evicted when there are more than `limit` of them,
+    or when more than `max_values` values are recorded in total (lists
+    count each item).
+    """
+
+    def __init__(self, paths: tuple[str, ...], limit: int, max_values: int):
+        self.paths = paths
+        self.limit = limit
+        self.max_values = max_values
+
+        self.undos: deque[list[tuple]] = deque()
+        self.redos: list[list[tuple]] = []
+        # Number of values recorded in undos and redos.
+        self.size = 0
+
+        # Previous values of the entry being recorded, keyed by (id(node), key).
+        self.pending: dict[tuple, tuple] = {}
+        # Whether undo() or redo() is setting values.
+        self.applying = False
+
+    def save(self, node: 'DictNode | ListNode', key) -> None:
+        """ Record value before the change, if it is under tracked paths. """
+        if self.applying or (id(node), key) in self.pending:
+            return
+        path = node._appstate_path if key is None else f'{node._appstate_path}.{key}'
+        for tracked in self.paths:
+            if path == tracked or path.startswith(tracked + '.') \
+                    or tracked.startswith(path + '.'):
+                break
+        else:
+            return
+        if isinstance(node, ListNode):
+            # Lists are saved as a whole.
+            self.pending[id(node), key] = (node, key, list(node.data))
+        else:
+            self.pending[id(node), key] = (node, key, node.data.get(key, MISSING))
+
+    def commit(self) -> None:
+        """ Close the entry, with current values to redo. """
+        if not self.pending:
+            return
+        records = []
+        for node, key, old in self.pending.values():
+            if isinstance(node, ListNode):
+                new = list(node.data)
+                if len(old) == len(new) and all(x is y for x, y in zip(old, new)):
+                    continue
+            else:
+                new = node.data.get(key, MISSING)
+                if old is new:
+                    # Reverted, like in a transaction rolled back.
+                    continue
+            records.append((node, key, old, new))
+        self.pending = {}
+        if not records:
+            return
+
+        for entry in self.redos:
+            self.size -= self.weight(entry)
+        self.redos = []
+        self.undos.append(records)
+        self.size += self.weight(records)
+        while self.undos and (len(self.undos) > self.limit or self.size > self.max_values):
+            self.size -= self.weight(self.undos.popleft())
+
+    @staticmethod
+    def weight(records: list[tuple]) -> int:
+        """ Number of values recorded in the entry. """
+        return sum(
+            len(old) + len(new) if type(old) is list else 1
+            for node, key, old, new in records
+        )
+
+    def undo(self) -> bool:
+        """ Revert the last entry. Return False if there is nothing to undo. """
+        self.commit()
+        if not self.undos:
+            return False
+        records = self.undos.pop()
+        self.apply([(node, key, old) for node, key, old, new in reversed(records)])
+        self.redos.append(records)
+        return True
+
+    def redo(self) -> bool:
+        """ Repeat the last undone entry. Return False if there is nothing to redo. """
+        self.commit()
+        if not self.redos:
+            return False
+        records = self.redos.pop()
+        self.apply([(node, key, new) for node, key, old, new in records])
+        self.undos.append(records)
+        return True
+
+    def apply(self, values: list[tuple]) -> None:
+        """
+        Set recorded values. Handlers are delivered once, in a batch. Values
+        are saved like any other change, for the storage and the enclosing
+        transactions, but not recorded in the history.
+        """
+        self.applying = True
+        try:
+            with Batch():
+                for node, key, value in values:
+                    Batch.save(node, key)
+                    if isinstance(node, ListNode):
+                        node.data[:] = value
+                        node._reindex()
+                        node._changed()
+                        continue
+                    old = node.data.get(key, MISSING)
+                    if value is MISSING:
+                        node.data.pop(key, None)
+                    else:
+                        node.data[key] = value
+                    node._appstate_touch()
+                    path = f'{node._appstate_path}.{key}'
+                    on.trigger(path, Change(path, old, value, 'delete' if value is MISSING else 'set'))
+        finally:
+            self.applying = False
+
+
+# Enabled by state.track_history()
+history: History | None = None
+
+
+class Profiler:
+    """
+    Statistics of signal handler calls, trigger fan-out and persistence
+    flushes, enabled by on.profile(). If `trace` is True, every call and
+    flush is also recorded as an event for on.export_trace().
+    """
+
+    def __init__(self, trace: bool = False):
+        self.start = perf_counter()
+        self.handlers: dict[str, dict] = defaultdict(lambda: {'calls': 0, 'total': 0.0, 'max': 0.0})
+        self.paths: dict[str, dict] = defaultdict(lambda: {'triggers': 0, 'handlers': 0, 'max': 0})
+        self.flushes: dict[str, dict] = defaultdict(
+            lambda: {'count': 0, 'bytes': 0, 'total': 0.0, 'max': 0.0}
+        )
+        self.events: list[dict] | None = [] if trace else None
+
+    def handler(self, name: str, start: float) -> None:
+        """ Record call of the handler, started at `start`. """
+        duration = perf_counter() - start
+        stats = self.handlers[name]
+        stats['calls'] += 1
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+        if self.events is not None:
+            self.event(name, 'handler', start, duration)
+
+    def trigger(self, path: str, handlers: int) -> None:
+        """ Record change of the path, delivered to a number of handlers. """
+        stats = self.paths[path]
+        stats['triggers'] += 1
+        stats['handlers'] += handlers
+        stats['max'] = max(stats['max'], handlers)
+
+    def flush(self, kind: str, size: int, start: float) -> None:
+        """ Record persistence flush of `size` bytes, started at `start`. """
+        duration = perf_counter() - start
+        stats = self.flushes[kind]
+        stats['count'] += 1
+        stats['bytes'] += size
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+        if self.events is not None:
+            self.event(f'flush {kind}', 'persistence', start, duration, bytes=size)
+
+    def event(self, name: str, category: str, start: float, duration: float, **args) -> None:
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.start) * 1e6,
+            'dur': duration * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+    def stats(self) -> dict:
+        return {
+            'handlers': {name: dict(x) for name, x in self.handlers.items()},
+            'paths': {path: dict(x) for path, x in self.paths.items()},
+            'flushes': {kind: dict(x) for kind, x in self.flushes.items()},
+        }
+
+
+# Enabled by on.profile()
+profiler: Profiler | None = None
+
+
+# Storage of state.autopersist(), marking changed subtrees dirty.
+persisted: Storage | None = None
+
+
+# Whether persist_delayed() is waiting already.
+persist_pending = False
 
 
-@lock_or_exit()
 async def persist_delayed(timeout):
-    logger.debug('Saving state:\n{items}'.format(items="\n".join(
-        f'{key}: {shorten(str(value), 60)}' for key, value in state.items()
-    )))
-    if current_async_library() == 'trio':
-        await trio.sleep(timeout)
-    else:
-        await asyncio.sleep(timeout)
+    """ Flush the state after timeout, unless a delayed flush is pending. """
+    global persist_pending
+    if persist_pending:
+        return
+    persist_pending = True
+    try:
+        if current_async_library() == 'trio':
+            import trio
+            await trio.sleep(timeout)
+        else:
+            await asyncio.sleep(timeout)
+    finally:
+        persist_pending = False
     #logger.debug('PERSIST', state)
-    state._appstate_shelve['state'] = state.as_dict()
-    state._appstate_shelve.sync()
+    state._appstate_storage.flush(state)
 
 
-def maybe_async(callable: Coroutine | Callable):
+def maybe_async(callable: Coroutine | Callable, **kwargs):
     """
     Execute sync callable, or schedule async task.
     """
     if not inspect.iscoroutinefunction(callable):
-        return callable()
+        return callable(**kwargs)
 
-    if current_async_library() == 'trio':
+    if running_async_library() == 'trio':
         if not getattr(state, '_nursery'):
             raise Exception('Provide state._nursery for async task to run.')
-        state._nursery.start_soon(callable)
+        state._nursery.start_soon(partial(callable, **kwargs))
     else:
-        return asyncio.create_task(callable())
+        return asyncio.create_task(callable(**kwargs))
+
+
+def running_async_library() -> str | None:
+    """ Name of the async library running in this thread, if any. """
+    try:
+        return current_async_library()
+    except AsyncLibraryNotFoundError:
+        pass
+    try:
+        # sniffio only detects asyncio inside a task, not in callbacks.
+        asyncio.get_running_loop()
+        return 'asyncio'
+    except RuntimeError:
+        return None
+
+
+def call_later(delay: float, callback: Callable) -> Callable | None:
+    """
+    Call the callback after `delay` seconds, in the running asyncio or trio
+    event loop, or with the kivy Clock. Return function cancelling the call,
+    or None if there is nothing to delay the call with.
+    """
+    library = running_async_library()
+    if library == 'trio':
+        import trio
+        scope = trio.CancelScope()
+
+        async def sleep():
+            with scope:
+                await trio.sleep(delay)
+                callback()
+
+        if not getattr(state, '_nursery', None):
+            raise Exception('Provide state._nursery for async task to run.')
+        state._nursery.start_soon(sleep)
+        return scope.cancel
+    if library == 'asyncio':
+        return asyncio.get_running_loop().call_later(delay, callback).cancel
+    if 'kivy' in sys.modules:
+        from kivy.clock import Clock
+        return Clock.schedule_once(lambda dt: callback(), delay).cancel
+    return None
+
+
+class DeliveryQueue:
+    """
+    Pending runs of async signal handlers. Each async handler (or a method
+    of each instance) has at most one pending run: changes triggering it
+    while the run is pending are coalesced into it. A task is started for
+    the handler only if it is not running already; the task runs it again
+    while there are pending changes, so that a burst of changes costs one
+    or two runs instead of a task per change.
+
+    Number of pending changes is bounded by `maxsize`. On overflow, policy
+    'drop_oldest' discards the oldest pending changes, 'drop_newest' the
+    incoming ones, and 'error' raises asyncio.QueueFull in the code which
+    changed the state. The handler run itself is never dropped.
+
+    Replace `on.queue` to configure:
+
+        on.queue = DeliveryQueue(maxsize=1000, overflow='drop_newest')
+    """
+
+    def __init__(self, maxsize: int = 100_000, overflow: str = 'drop_oldest'):
+        if overflow not in ('drop_oldest', 'drop_newest', 'error'):
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        self.maxsize = maxsize
+        self.overflow = overflow
+
+        # Pending changes, keyed by the async callable.
+        self.pending: dict[Callable, list[Change]] = {}
+        self.running: set[Callable] = set()
+        self.tasks: set[asyncio.Task] = set()
+
+        # Metrics
+        self.size = 0
+        self.max_size = 0
+        self.runs = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def submit(self, handler: 'signal_handler', callable: Callable, changes: list[Change]):
+        """ Schedule run of the async callable, with the given changes. """
+        if self.size + len(changes) > self.maxsize:
+            if self.overflow == 'error':
+                raise asyncio.QueueFull(f'{self.size} changes are pending delivery')
+            if self.overflow == 'drop_newest':
+                if callable in self.pending:
+                    self.dropped += len(changes)
+                    return self.schedule(handler, callable)
+                # Keep the last change for the run.
+                self.dropped += len(changes) - 1
+                changes = changes[-1:]
+            if self.overflow == 'drop_oldest':
+                self.drop(self.size + len(changes) - self.maxsize)
+
+        if callable in self.pending:
+            self.coalesced += 1
+            self.pending[callable].extend(changes)
+        else:
+            self.pending[callable] = list(changes)
+        self.size += len(changes)
+        self.max_size = max(self.max_size, self.size)
+        self.schedule(handler, callable)
+
+    def drop(self, count: int) -> None:
+        """ Discard the oldest pending changes, keeping the last one of each run. """
+        for changes in self.pending.values():
+            n = min(count, len(changes) - 1)
+            del changes[:n]
+            self.size -= n
+            self.dropped += n
+            count -= n
+            if count <= 0:
+                break
+
+    def schedule(self, handler: 'signal_handler', callable: Callable) -> None:
+        if callable in self.running:
+            return
+        self.running.add(callable)
+        task = maybe_async(self.run, handler=handler, target=callable)
+        if task:
+            # Event loop only keeps weak references to tasks.
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self, handler: 'signal_handler', target: Callable) -> None:
+        try:
+            while target in self.pending:
+                changes = self.pending.pop(target)
+                self.size -= len(changes)
+                self.runs += 1
+                start = perf_counter()
+                try:
+                    await target(**handler.kwargs(changes))
+                except Exception:
+                    logger.exception(f'Error in signal handler {target}')
+                if profiler is not None:
+                    profiler.handler(handler.name, start)
+        finally:
+            self.running.discard(target)
+
+    def stats(self) -> dict:
+        """ Queue metrics. """
+        return {
+            'size': self.size,
+            'max_size': self.max_size,
+            'pending_runs': len(self.pending),
+            'running': len(self.running),
+            'runs': self.runs,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+        }
+
+
+# Creation order of signal handlers, see delivery_order().
+handler_order = count()
+
+
+def delivery_order(handler: 'signal_handler') -> tuple:
+    """ Sort key of handlers to deliver: by priority, then by creation. """
+    return (-handler.priority, handler.order)
+
+
+def watch_init(cls: type) -> None:
+    """
+    Wrap __init__() of the class, to bind method handlers with patterns
+    referring to {self} once the outermost __init__() returns. Subclasses
+    defining their own __init__() are wrapped when created.
+    """
+    if '_appstate_init' in cls.__dict__:
+        return
+    init = cls.__init__
+
+    @wraps(init)
+    def __init__(instance, *args, **kwargs):
+        init(instance, *args, **kwargs)
+        if type(instance).__init__ is __init__:
+            # Not called from __init__() of a subclass, attributes are set.
+            for klass in type(instance).__mro__:
+                for handler in klass.__dict__.get('_appstate_templated', ()):
+                    handler.bind(instance)
+
+    cls.__init__ = cls._appstate_init = __init__
+
+    if '_appstate_init_subclass' in cls.__dict__ or any(
+        '_appstate_init_subclass' in x.__dict__ for x in cls.__mro__[1:]
+    ):
+        return
+    original = cls.__dict__.get('__init_subclass__')
+
+    def __init_subclass__(subclass, **kwargs):
+        if original is not None:
+            original.__func__(subclass, **kwargs)
+        else:
+            super(cls, subclass).__init_subclass__(**kwargs)
+        if '__init__' in subclass.__dict__:
+            watch_init(subclass)
+
+    cls.__init_subclass__ = classmethod(__init_subclass__)
+    cls._appstate_init_subclass = True
+
+
+def accepts_argument(callable: Callable, name: str) -> bool:
+    """ Check whether callable has a parameter with the given name. """
+    try:
+        return name in inspect.signature(callable).parameters
+    except (TypeError, ValueError):
+        return False
 
 
 class signal_handler:
@@ -373,15 +2255,101 @@ class signal_handler:
     When the state changes, deliver() calls the method for each instance of the
     owner class.
 
+    Wrapped callable may opt in to receive description of the changes
+    which triggered it, by having parameters with these names:
+
+        paths - list of changed paths
+        change - Change record of the last change
+        changes - list of Change records, several if changes were batched
+        wildcards - path segments matched by the pattern wildcards, in
+                    the last change
+
+    If `debounce` is given, the callable is called once changes stop for
+    `debounce` seconds. If `throttle` is given, it is called at most once
+    per `throttle` seconds: the first change is delivered at once, the
+    changes made meanwhile - when the period ends. Delayed changes are
+    delivered together.
+
+    If `weak` is True, a bound method or a callable object is referenced
+    weakly, and the handler is disconnected once it (or the instance of
+    the bound method) is garbage collected. Functions are always referenced
+    strongly: a decorated function is referenced by nothing else.
+
+    Handlers with higher `priority` are delivered first, handlers with
+    equal priority - in order of creation.
+
+    Method patterns may refer to the instance attributes, like
+    'state.countries.{self.code}'. Such patterns are formatted for each
+    instance once its outermost __init__() returns, and only the matching
+    instances are called, see bind() and watch_init(). The instance is
+    referenced weakly.
     """
 
-    def __init__(self, callable: Callable):
-        self.callable = callable
+    def __init__(
+        self,
+        callable: Callable,
+        debounce: float | None = None,
+        throttle: float | None = None,
+        weak: bool = False,
+        priority: float = 0,
+    ):
+        if debounce and throttle:
+            raise ValueError('Provide either debounce or throttle, not both.')
+        self.weak = weak = weak and not inspect.isfunction(callable)
+        if weak:
+            ref = weakref.WeakMethod if inspect.ismethod(callable) else weakref.ref
+            self.reference = ref(callable, lambda ref: self.disconnect())
+            self.callable = None
+        else:
+            self.callable = callable
+        self.is_async = inspect.iscoroutinefunction(callable)
         self.owner_class = None
+        self.priority = priority
+        self.order = next(handler_order)
+
+        # Patterns this handler is subscribed to.
+        self.patterns: list[str] = []
+        # Patterns referring to attributes of self, and handlers subscribing
+        # instances to them.
+        self.templates: list[str] = []
+        self.bindings: weakref.WeakSet[signal_handler] = weakref.WeakSet()
+
+        self.debounce = debounce
+        self.throttle = throttle
+        # Changes waiting for the delayed call, and function cancelling it.
+        self.delayed: list[Change] = []
+        self.timer: Callable | None = None
+        self.arguments = [
+            name for name in ('paths', 'change', 'changes', 'wildcards')
+            if accepts_argument(callable, name)
+        ]
         update_wrapper(self, callable)
+        if weak:
+            del self.__wrapped__
+        self.name = f"{self.__module__}.{getattr(self, '__qualname__', repr(callable))}"
 
     def __call__(self, *a, **kw):
-        return self.callable(*a, **kw)
+        return self.target()(*a, **kw)
+
+    def target(self) -> Callable | None:
+        """ Wrapped callable, or None if it was referenced weakly and is gone. """
+        return self.reference() if self.weak else self.callable
+
+    def disconnect(self) -> None:
+        """ Unsubscribe from all patterns. Pending delayed call is cancelled. """
+        with on.lock:
+            for pattern in self.patterns:
+                on.index.remove(pattern, self)
+                if not on.handlers.get(pattern + '.'):
+                    on.handlers.pop(pattern + '.', None)
+            self.patterns = []
+            self.templates = []
+        for binding in list(self.bindings):
+            binding.disconnect()
+        if self.timer:
+            self.timer()
+            self.timer = None
+        self.delayed = []
 
     def __set_name__(self, owner: type, name: str):
         """
@@ -392,21 +2360,264 @@ class signal_handler:
         if not hasattr(owner, '_appstate_instances'):
             owner._appstate_instances = InstanceManager(owner, '_appstate_instances')
 
-        setattr(owner, self.callable.__name__, self.callable)
+        setattr(owner, self.__name__, self.target())
         self.owner_class = owner
 
-    def deliver(self):
+        if self.templates:
+            if '_appstate_templated' not in owner.__dict__:
+                owner._appstate_templated = []
+            owner._appstate_templated.append(self)
+            watch_init(owner)
+
+    def bind(self, instance) -> 'signal_handler | None':
+        """
+        Subscribe method of the instance to the patterns referring to
+        attributes of self, formatted with the instance. The subscription
+        is released once the instance is garbage collected.
+        """
+        if not self.templates:
+            return None
+        patterns = [pattern.format(self=instance) for pattern in self.templates]
+        binding = on(
+            *patterns, debounce=self.debounce, throttle=self.throttle,
+            priority=self.priority, weak=True,
+        )(getattr(instance, self.__name__))
+        self.bindings.add(binding)
+        return binding
+
+    def kwargs(self, changes: list[Change]) -> dict:
+        """ Arguments describing the changes, which the callable accepts. """
+        kwargs = {}
+        if 'paths' in self.arguments:
+            kwargs['paths'] = list(dict.fromkeys(change.path for change in changes))
+        if 'change' in self.arguments:
+            kwargs['change'] = changes[-1]
+        if 'changes' in self.arguments:
+            kwargs['changes'] = changes
+        if 'wildcards' in self.arguments:
+            kwargs['wildcards'] = changes[-1].wildcards
+        return kwargs
+
+    def deliver(self, changes: list[Change]):
         """
         Called by on.trigger() when state changes. Execute wrapped callable
         or call a method of all owner class instances. If async, schedule
-        a task.
+        the run in on.queue.
         """
+        if self.debounce or self.throttle:
+            self.delayed.extend(changes)
+            if self.debounce:
+                if self.timer:
+                    self.timer()
+                self.timer = call_later(self.debounce, self.deliver_delayed)
+                if self.timer is None:
+                    # No event loop is running, deliver at once.
+                    self.deliver_delayed()
+            elif not self.timer:
+                # Not throttled at the moment.
+                self.deliver_delayed()
+            return
+
+        self.call(changes)
+
+    def deliver_delayed(self):
+        """ Deliver changes delayed by debounce or throttle. """
+        changes, self.delayed = self.delayed, []
+        self.timer = None
+        if not changes:
+            return
+        if self.throttle:
+            # Delay changes until the end of the throttle period.
+            self.timer = call_later(self.throttle, self.deliver_delayed)
+        self.call(changes)
+
+    def call(self, changes: list[Change]):
+        """ Execute wrapped callable, or call method of every instance. """
         if self.owner_class:
             # Call method of every existing instance of an owner class.
-            for instance in self.owner_class._appstate_instances.all():
-                maybe_async(getattr(instance, self.callable.__name__))
+            callables = [
+                getattr(instance, self.__name__)
+                for instance in self.owner_class._appstate_instances.all()
+            ]
+        else:
+            callable = self.target()
+            if callable is None:
+                return self.disconnect()
+            callables = [callable]
+
+        if self.is_async:
+            for callable in callables:
+                on.queue.submit(self, callable, changes)
         else:
-            maybe_async(self.callable)
+            kwargs = self.kwargs(changes)
+            for callable in callables:
+                if profiler is None:
+                    callable(**kwargs)
+                    continue
+                start = perf_counter()
+                try:
+                    callable(**kwargs)
+                finally:
+                    profiler.handler(self.name, start)
+
+
+class PatternTrie:
+    """
+    Index of signal handlers, keyed by dot-separated segments of the state
+    path patterns. Used by on.match() to find handlers of the changed node,
+    its ancestors and its descendants in time proportional to the path depth
+    plus the number of matches, instead of scanning every registered pattern.
+
+    Each trie node keeps the list of handlers subscribed exactly to its path.
+    Nodes without handlers and children are pruned on removal, so that
+    walking any subtree only visits nodes leading to some handler.
+
+    Pattern segment `*` matches any single path segment, `**` matches any
+    number of segments, including none: 'state.countries.*.population',
+    'state.**.updated_at'. Segments matched by wildcards are captured,
+    `**` captures its segments joined with dots.
+    """
+
+    def __init__(self, parent: 'PatternTrie | None' = None, segment: str | None = None):
+        self.parent = parent
+        self.segment = segment
+        self.children: dict[str, PatternTrie] = {}
+        self.handlers: list[signal_handler] = []
+
+        # Number of subscribed patterns with wildcards, counted in the root.
+        self.wildcards = 0
+
+    def add(self, pattern: str, handler: signal_handler) -> 'PatternTrie':
+        """ Subscribe handler to the pattern. Return trie node of the pattern. """
+        if has_wildcards(pattern):
+            self.wildcards += 1
+        node = self
+        for segment in pattern.split('.'):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = PatternTrie(node, segment)
+            node = child
+        node.handlers.append(handler)
+        return node
+
+    def find(self, pattern: str) -> 'PatternTrie | None':
+        node = self
+        for segment in pattern.split('.'):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def remove(self, pattern: str, handler: signal_handler) -> None:
+        """ Unsubscribe handler from the pattern, pruning empty trie nodes. """
+        node = self.find(pattern)
+        if node is None:
+            return
+        if handler in node.handlers:
+            node.handlers.remove(handler)
+            if has_wildcards(pattern):
+                self.wildcards -= 1
+        node.prune()
+
+    def prune(self) -> None:
+        node = self
+        while node.parent is not None and not node.handlers and not node.children:
+            del node.parent.children[node.segment]
+            node = node.parent
+
+    def match(self, path: str, subtree: bool = True) -> list[tuple[signal_handler, tuple]]:
+        """
+        Return handlers of the given path, of all its ancestors and of all
+        its descendants, paired with the segments captured by wildcards of
+        their patterns. Wildcards beyond the end of the path capture None.
+
+        If `subtree` is False, the changed value had no descendants, and
+        patterns continuing after `**` are not matched - otherwise
+        'state.**.updated_at' would match a change of any path.
+        """
+        if self.wildcards:
+            return self.match_wildcards(path, subtree)
+
+        result = []
+        node = self
+        for segment in path.split('.'):
+            node = node.children.get(segment)
+            if node is None:
+                return [(handler, ()) for handler in result]
+            # state.foo. handler triggered by change of state.foo.bar
+            result.extend(node.handlers)
+
+        # state.foo.bar. handler triggered by change of state.foo
+        stack = list(node.children.values())
+        while stack:
+            node = stack.pop()
+            result.extend(node.handlers)
+            stack.extend(node.children.values())
+        return [(handler, ()) for handler in result]
+
+    def match_wildcards(self, path: str, subtree: bool) -> list[tuple[signal_handler, tuple]]:
+        """ Slower match(), following wildcard branches of the trie. """
+        # Trie nodes matching the path so far, mapped to captured segments.
+        frontier = {self: ()}
+        matched = {}
+        for segment in path.split('.'):
+            step = {}
+            for node, captured in frontier.items():
+                if node.segment == '**':
+                    last = captured[-1]
+                    step.setdefault(node, captured[:-1] + (f'{last}.{segment}' if last else segment,))
+                child = node.children.get(segment)
+                if child is not None:
+                    step.setdefault(child, captured)
+                child = node.children.get('*')
+                if child is not None:
+                    step.setdefault(child, captured + (segment,))
+            frontier = self.expand(step)
+            if not frontier:
+                break
+            for node, captured in frontier.items():
+                # state.foo. handler triggered by change of state.foo.bar
+                # Node matched again, by `**` with more segments, captures them.
+                matched[node] = captured
+
+        # state.foo.bar. handler triggered by change of state.foo
+        stack = [
+            (node, captured) for node, captured in frontier.items()
+            if subtree or node.segment != '**'
+        ]
+        while stack:
+            node, captured = stack.pop()
+            for child in node.children.values():
+                if child in matched:
+                    continue
+                if child.segment == '*' or child.segment == '**':
+                    matched[child] = captured + (None,)
+                else:
+                    matched[child] = captured
+                stack.append((child, matched[child]))
+
+        return [
+            (handler, captured)
+            for node, captured in matched.items()
+            for handler in node.handlers
+        ]
+
+    @staticmethod
+    def expand(frontier: dict) -> dict:
+        """ Add `**` children of the frontier nodes, matching no segments. """
+        stack = list(frontier.items())
+        while stack:
+            node, captured = stack.pop()
+            child = node.children.get('**')
+            if child is not None and child not in frontier:
+                frontier[child] = captured + ('',)
+                stack.append((child, frontier[child]))
+        return frontier
+
+
+def has_wildcards(pattern: str) -> bool:
+    """ Whether the pattern has `*` or `**` segments. """
+    return '*' in pattern and any(x in ('*', '**') for x in pattern.split('.'))
 
 
 class on:
@@ -427,9 +2638,36 @@ class on:
     # Watchlist mapping 'state.foo.' -> list of callables
     handlers: dict[str, list[signal_handler]] = defaultdict(list)
 
-    def __init__(self, *patterns: str):
-        """ Set state path patterns to react on. """
-        self.patterns = patterns
+    # Same handlers, indexed by path segments for fast matching.
+    index = PatternTrie()
+
+    # Guards the index, when handlers are added from several threads.
+    lock = threading.RLock()
+
+    # Pending runs of async handlers.
+    queue = DeliveryQueue()
+
+    def __init__(
+        self,
+        *patterns: 'str | DictNode | computed',
+        debounce: float | None = None,
+        throttle: float | None = None,
+        weak: bool = False,
+        priority: float = 0,
+    ):
+        """
+        Set state path patterns to react on. Instead of a string pattern,
+        a state node or a computed value may be given.
+
+        `debounce` and `throttle` limit how often the handler is called,
+        `weak` makes it disconnect when the callable is garbage collected,
+        handlers with higher `priority` are called first, see signal_handler.
+        """
+        self.patterns = [getattr(x, '_appstate_path', x) for x in patterns]
+        self.debounce = debounce
+        self.throttle = throttle
+        self.weak = weak
+        self.priority = priority
 
 
     def __call__(self, callable: Callable) -> signal_handler:
@@ -444,41 +2682,208 @@ class on:
         Add this signal handler to the watchlist to react on state
         changes with given state path patterns.
         """
-        handler = signal_handler(callable)
-
-        for pattern in self.patterns:
-            # Ensure path pattern ends with a dot. Enables simple
-            # substring path matching in on.match(), distinguishing
-            # state.foo from state.foobar
-            on.handlers[pattern + '.'].append(handler)
+        handler = signal_handler(
+            callable, debounce=self.debounce, throttle=self.throttle, weak=self.weak,
+            priority=self.priority,
+        )
+
+        handler.templates = [x for x in self.patterns if '{self' in x]
+        if handler.templates and next(iter(inspect.signature(callable).parameters), None) != 'self':
+            raise ValueError('Patterns referring to {self} are only supported for methods')
+
+        with on.lock:
+            for pattern in self.patterns:
+                if pattern in handler.templates:
+                    continue
+                # Watchlist shares handler list object with the index node.
+                # Pattern key ends with a dot for backward compatibility.
+                on.handlers[pattern + '.'] = on.index.add(pattern, handler).handlers
+                handler.patterns.append(pattern)
 
         return handler
 
+    @staticmethod
+    def profile(enabled: bool = True, trace: bool = False) -> None:
+        """
+        Start collecting statistics for on.stats(), discarding previous
+        ones, or stop if `enabled` is False. If `trace` is True, also record
+        events for on.export_trace().
+        """
+        global profiler
+        profiler = Profiler(trace=trace) if enabled else None
+
+    @staticmethod
+    def stats() -> dict:
+        """
+        Statistics collected since on.profile() was called:
+
+            handlers - {handler name: {calls, total, max}}, seconds
+            paths - {changed path: {triggers, handlers, max}}, number of
+                    changes, and total and max number of handlers called
+            flushes - {'journal' or 'snapshot': {count, bytes, total, max}}
+        """
+        if profiler is None:
+            return {'handlers': {}, 'paths': {}, 'flushes': {}}
+        return profiler.stats()
 
     @staticmethod
-    def trigger(path: str) -> None:
+    def export_trace(filename: str | Path) -> None:
+        """
+        Write events recorded with on.profile(trace=True) as Chrome trace
+        JSON, to be opened in chrome://tracing or Perfetto.
+        """
+        events = profiler.events if profiler and profiler.events is not None else []
+        Path(filename).write_text(json.dumps({'traceEvents': events}))
+
+    @staticmethod
+    def unregister(handler: signal_handler) -> None:
+        """ Stop calling the handler, returned by @on(), on state changes. """
+        handler.disconnect()
+
+
+    @staticmethod
+    def trigger(path: str, change: Change | None = None) -> None:
         """
         Execute all signal handlers that match given path pattern.
 
         Called by DictNode when it is changed. Parameter `path` is changed node's
-        _appstate_path. For ex: "state.countries.au"
+        _appstate_path. For ex: "state.countries.au". Parameter `change`
+        describes the change for handlers which want it.
+
+        Inside state.batch() the change is recorded, and handlers are
+        delivered when the batch exits.
         """
-        for handler in on.match(path + '.'):
-            handler.deliver()
+        if change is None:
+            change = Change(path, MISSING, MISSING, 'update')
+
+        batch = current_batch.get()
+        if batch and not batch.closed:
+            batch.changes.append(change)
+            return
+
+        if history is not None:
+            history.commit()
+
+        if threads is not None and threading.get_ident() != threads.thread:
+            return threads.submit([change])
+
+        # Handler subscribed to several matching patterns is delivered once.
+        matches = {}
+        for handler, wildcards in on.matches(path, change.subtree):
+            matches.setdefault(handler, wildcards)
+        if profiler is not None:
+            profiler.trigger(path, len(matches))
+        for handler in sorted(matches, key=delivery_order) if len(matches) > 1 else matches:
+            handler.deliver([change.matched(matches[handler])])
 
     @staticmethod
     def match(path: str) -> Generator[signal_handler]:
         """
-        Yield all signal_handlers that match given path pattern.
-        Called by on.trigger().
+        Yield all signal_handlers that match given path pattern, once each.
+
+        Matching handlers are collected before yielding, so handlers may
+        subscribe or unsubscribe while being delivered.
+        """
+        yield from dict.fromkeys(handler for handler, wildcards in on.matches(path))
+
+    @staticmethod
+    def matches(path: str, subtree: bool = True) -> list[tuple[signal_handler, tuple]]:
+        """
+        Handlers that match given path, paired with the segments captured
+        by wildcards of their patterns. Called by on.trigger().
+        See PatternTrie.match() for `subtree`.
+        """
+        with on.lock:
+            return on.index.match(path.rstrip('.'), subtree)
+
+
+class computed:
+    """
+    Decorator of a function, which computes a value derived from the state.
+    The value is cached. Paths of the state nodes read by the function are
+    recorded, and the cached value is invalidated when any of them changes.
+
+    Computed value can be subscribed to with @on(). In that case it is
+    recomputed right after invalidation, and subscribers are triggered
+    only if the new value differs from the old one.
+
+    Usage:
+
+        @computed
+        def total_population():
+            return sum(x.population for x in state.countries.values())
+
+        @on(total_population)
+        def show_total():
+            label.text = str(total_population())
+
+    `disconnect()` stops tracking the dependencies, like for signal handlers.
+    """
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self._appstate_path = f'computed.{func.__module__}.{func.__qualname__}'
+        self.value = MISSING
+
+        # Paths this value depends on, subscribed to with self.handler.
+        self.dependencies: set[str] = set()
+
+        self.handler = signal_handler(self.invalidate)
+        # Invalidate before the handlers which may read this value run.
+        self.handler.priority = float('inf')
+
+        update_wrapper(self, func)
+
+    def __call__(self):
+        if readers:
+            # Computed value read by another one.
+            readers[-1].add(self._appstate_path)
+        if self.value is MISSING:
+            self.evaluate()
+        return self.value
+
+    def evaluate(self) -> None:
+        readers.append(set())
+        try:
+            self.value = self.func()
+        finally:
+            self.subscribe(readers.pop())
+
+    def subscribe(self, paths: set[str]) -> None:
+        """ Update subscriptions to the dependency paths. """
+        # Change of a node signals its descendants, no need to subscribe
+        # to the paths inside another dependency.
+        dependencies = set()
+        last = None
+        for path in sorted(paths):
+            if last is None or not path.startswith(last + '.'):
+                dependencies.add(path)
+                last = path
+
+        with on.lock:
+            for path in self.dependencies - dependencies:
+                on.index.remove(path, self.handler)
+            for path in dependencies - self.dependencies:
+                on.index.add(path, self.handler)
+        self.dependencies = dependencies
+
+    def disconnect(self) -> None:
+        """
+        Unsubscribe from the dependencies and drop the cached value. The
+        value is computed again, and subscribed to, on the next call.
         """
-        for pattern in list(on.handlers):
-            if pattern.startswith(path):
-                # state.foo.bar. handler triggered by change of state.foo.
-                yield from on.handlers[pattern]
-            elif path.startswith(pattern):
-                # state.foo. handler triggered by change of state.foo.bar.
-                yield from on.handlers[pattern]
+        self.subscribe(set())
+        self.value = MISSING
+
+    def invalidate(self) -> None:
+        old, self.value = self.value, MISSING
+        if old is MISSING or not on.index.find(self._appstate_path):
+            # Not subscribed, recompute lazily.
+            return
+
+        new = self()
+        if not new == old:
+            on.trigger(self._appstate_path, Change(self._appstate_path, old, new, 'set'))
 
 
 state = State(path='state')
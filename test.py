@@ -1,7 +1,9 @@
 from app_state import state, State, on
 from unittest.mock import Mock, patch, MagicMock
 from pathlib import Path
+import pickle
 import pytest
+import weakref
 import app_state
 
 
@@ -25,6 +27,7 @@ def clean_state():
     for handler in list(on.handlers['state.']):
         if handler.__qualname__ == 'State.autopersist.<locals>.persist':
             on.handlers['state.'].remove(handler)
+    app_state.persisted = None
 
     state.reset()
 
@@ -78,13 +81,13 @@ def test_autopersist(tmp_path: Path):
         country.value = 9
 
     assert state == {'countries': [
-        {'id': 'AU', 'questions': [ {'id': 1} ]}
+        {'id': 'AU', 'questions': [ {'id': 1} ], 'value': 9}
     ]}
 
     state.reload(tmp_path / 'state.db.shelve')
 
     assert state == {'countries': [
-        {'id': 'AU', 'questions': [ {'id': 1} ]}
+        {'id': 'AU', 'questions': [ {'id': 1} ], 'value': 9}
     ]}
 
 
@@ -113,7 +116,6 @@ def test_get():
     au.answers = 'none'
     assert state.countries.AU.answers == 'none'
 
-    # TODO: lists don't get updated yet
     au.questions.append(456)
 
     au = state.countries.get('AU')
@@ -121,7 +123,7 @@ def test_get():
     au.questions.append('789')
 
     assert state == {'countries' : {'AU': {
-        'questions': [  {'id': 1}, ],
+        'questions': [  {'id': 1}, 456, '789'],
         'answers': 'none'
     }}}
 
@@ -135,3 +137,926 @@ def test_values():
     assert {'id': 2} in values
 
     assert {x._appstate_path for x in values} == {'state.countries.AU', 'state.countries.RU'}
+
+
+def test_match_index():
+    handler = on('state.countries.AU', 'state.countries_extra')(lambda: None)
+
+    assert handler in list(on.match('state'))
+    assert handler in list(on.match('state.countries'))
+    assert handler in list(on.match('state.countries.AU.population'))
+    assert handler not in list(on.match('state.countries.RU'))
+    assert handler not in list(on.match('state.countrie'))
+
+    on.index.remove('state.countries.AU', handler)
+    on.index.remove('state.countries_extra', handler)
+    assert handler not in list(on.match('state.countries'))
+    assert on.index.find('state.countries_extra') is None
+
+
+def test_batch(mocker):
+    widget = Widget()
+    mocker.spy(widget, 'on_countries')
+    mocker.spy(__import__(__name__), 'australia_handler')
+
+    with state.batch():
+        state.countries.AU.population = 1
+        state.countries.AU.code = 'AU'
+        with state.batch():
+            state.countries.RU = {'code': 'RU'}
+        assert widget.on_countries.call_count == 0
+
+    assert widget.on_countries.call_count == 1
+    assert australia_handler.call_count == 1
+    assert state == {'countries': {'AU': {'population': 1, 'code': 'AU'}, 'RU': {'code': 'RU'}}}
+
+
+def test_transaction_rollback(mocker):
+    state.countries = {'AU': {'population': 1}}
+    widget = Widget()
+    mocker.spy(widget, 'on_countries')
+
+    with pytest.raises(ValueError):
+        with state.transaction():
+            state.countries.AU.population = 2
+            state.countries.RU.population = 3
+            del state.countries['AU']
+            raise ValueError
+
+    assert state == {'countries': {'AU': {'population': 1}}}
+    assert widget.on_countries.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_async_batch():
+    async with state.batch():
+        state.user.name = 'Alice'
+    assert state.user.name == 'Alice'
+
+    # Task started within the batch doesn't use it after it exits.
+    import asyncio
+    received = []
+
+    @on('state.x')
+    def handler(changes):
+        received.extend(change.path for change in changes)
+
+    async def task():
+        await asyncio.sleep(0)
+        state.x.update({'a': 1})
+        state.x.b = 2
+
+    async with state.batch():
+        started = asyncio.create_task(task())
+    await started
+    assert received == ['state.x.a', 'state.x.b']
+    handler.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_threadsafe(mocker):
+    mocker.patch.object(app_state, 'threads', None)
+    state.threadsafe()
+
+    import asyncio
+    import threading
+    delivered = []
+
+    @on('state.workers')
+    def handler(changes):
+        delivered.append((threading.get_ident(), len(changes)))
+
+    def work(name):
+        for i in range(1000):
+            state.workers[name][i] = i
+            state.log.append(i)
+
+    state.log = []
+    state.workers = {str(x): {} for x in range(4)}
+    threads = [threading.Thread(target=work, args=(str(x),)) for x in range(4)]
+    for thread in threads:
+        thread.start()
+    # Reading while other threads write.
+    while any(thread.is_alive() for thread in threads):
+        assert len(state.as_dict()['workers']) == 4
+        assert all(isinstance(key, int) for key in state.workers['0'])
+    for thread in threads:
+        thread.join()
+    await asyncio.sleep(0)
+
+    assert all(len(state.workers[str(x)]) == 1000 for x in range(4))
+    assert len(state.log) == 4000
+    assert {ident for ident, _ in delivered} == {threading.get_ident()}
+    # Initial change, then all changes made in threads, without losses.
+    assert sum(count for _, count in delivered) == 1 + 4000
+    handler.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_async_handler_coalescing(mocker):
+    import asyncio
+    queue = app_state.DeliveryQueue(maxsize=10, overflow='drop_oldest')
+    mocker.patch.object(on, 'queue', queue)
+    calls = []
+
+    @on('state.prices')
+    async def on_prices(changes):
+        calls.append([change.new for change in changes])
+        await asyncio.sleep(0)
+
+    for i in range(100):
+        state.prices.value = i
+    await asyncio.sleep(0.01)
+
+    # Changes are coalesced into one run, the oldest ones are dropped.
+    assert calls == [list(range(90, 100))]
+    assert queue.stats()['dropped'] == 90
+    assert queue.stats()['size'] == 0
+
+    on.queue.overflow = 'error'
+    state.prices.value = 0
+    with pytest.raises(asyncio.QueueFull):
+        state.prices.update({f'x{i}': i for i in range(20)})
+    await asyncio.sleep(0.01)
+    on_prices.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_debounce_throttle():
+    import asyncio
+    debounced = []
+    throttled = []
+
+    @on('state.search', debounce=0.05)
+    def search(changes):
+        debounced.append([change.new for change in changes])
+
+    @on('state.search', throttle=0.05)
+    def layout(changes):
+        throttled.append([change.new for change in changes])
+
+    for i in range(5):
+        state.search.query = i
+    assert debounced == []
+    assert throttled == [[0]]
+
+    await asyncio.sleep(0.1)
+    assert debounced == [[0, 1, 2, 3, 4]]
+    assert throttled == [[0], [1, 2, 3, 4]]
+
+    search.disconnect()
+    layout.disconnect()
+
+
+def test_debounce_without_loop():
+    calls = []
+
+    @on('state.y', debounce=0.1)
+    def debounced():
+        calls.append('debounced')
+
+    @on('state.y')
+    def plain():
+        calls.append('plain')
+
+    # Nothing to delay the call with, delivered at once.
+    state.y = 1
+    assert sorted(calls) == ['debounced', 'plain']
+    debounced.disconnect()
+    plain.disconnect()
+
+
+def test_unregister():
+    calls = []
+
+    class Widget:
+        def refresh(self):
+            calls.append(self)
+
+    widget = Widget()
+    handler = on('state.user', weak=True)(widget.refresh)
+    state.user.name = 'Alice'
+    assert calls == [widget]
+
+    del widget, calls[:]
+    assert handler.target() is None
+    assert on.index.find('state.user') is None
+    state.user.name = 'Bob'
+    assert calls == []
+
+    # Decorated function is the only reference to it, kept strongly.
+    @on('state.user', weak=True)
+    def decorated():
+        calls.append(1)
+
+    state.user.name = 'Alice'
+    assert calls == [1]
+    decorated.disconnect()
+    calls.clear()
+
+    @on('state.user', 'state.countries')
+    def both():
+        calls.append(1)
+
+    on.unregister(both)
+    state.user.name = 'Alice'
+    state.countries = {}
+    assert calls == []
+    assert both not in list(on.match('state.countries'))
+
+
+def test_wildcards():
+    received = []
+
+    @on('state.countries.*.population')
+    def population(wildcards):
+        received.append(wildcards)
+
+    @on('state.**.updated_at')
+    def updated(change):
+        received.append(change.wildcards)
+
+    # Replaced subtree may contain matching paths.
+    state.countries = {'AU': {'population': 1}}
+    assert set(received) == {(None,), ('countries',)}
+
+    received.clear()
+    state.countries.AU.population = 2
+    state.countries.AU.name = 'Australia'
+    state.countries.AU.updated_at = 1
+    assert received == [('AU',), ('countries.AU',)]
+
+    received.clear()
+    state.updated_at = 2
+    with state.batch():
+        state.countries.RU = {'population': 3}
+    assert set(received) == {('',), ('RU',), ('countries.RU',)}
+
+    # Trailing ** captures all the segments below.
+    received.clear()
+    nested = on('state.countries.**')(lambda wildcards: received.append(wildcards))
+    state.countries.AU.population = 4
+    assert ('AU.population',) in received
+
+    population.disconnect()
+    updated.disconnect()
+    nested.disconnect()
+    assert on.index.wildcards == 0
+
+
+def test_dispatch_order():
+    calls = []
+
+    @on('state.user', 'state.user.name')
+    def first():
+        calls.append('first')
+
+    @on('state.user.name', priority=1)
+    def feeder():
+        calls.append('feeder')
+
+    @on('state.**')
+    def last():
+        calls.append('last')
+
+    # Each handler is called once, even if several of its patterns match.
+    state.user.name = 'Alice'
+    assert calls == ['feeder', 'first', 'last']
+    assert list(on.match('state.user.name')).count(first) == 1
+
+    calls.clear()
+    with state.batch():
+        state.user.name = 'Bob'
+        state.user.age = 1
+    assert calls == ['feeder', 'first', 'last']
+
+    for handler in (first, feeder, last):
+        handler.disconnect()
+
+
+def test_instance_patterns():
+    import gc
+    calls = []
+
+    class CountryRow:
+        def __init__(self, code):
+            self.code = code
+
+        @on('state.countries.{self.code}')
+        def refresh(self, change):
+            calls.append((self.code, change.path))
+
+    state.countries = {'AU': {}, 'RU': {}}
+    rows = [CountryRow('AU'), CountryRow('RU')]
+    state.countries.RU.population = 1
+    assert calls == [('RU', 'state.countries.RU.population')]
+
+    del rows
+    gc.collect()
+    assert on.index.find('state.countries.RU') is None
+
+    # Subclass setting the attribute after super().__init__() is bound once
+    # its own __init__() returns.
+    class NamedRow(CountryRow):
+        def __init__(self, name):
+            super().__init__(None)
+            self.code = name.upper()
+
+    calls.clear()
+    row = NamedRow('au')
+    state.countries.AU.population = 2
+    assert calls == [('AU', 'state.countries.AU.population')]
+    assert on.index.find('state.countries.None') is None
+    del row
+
+    with pytest.raises(ValueError):
+        on('state.{self.code}')(lambda: None)
+
+
+def test_snapshot():
+    state.countries = {'AU': {'population': 1}, 'RU': {'population': 2}}
+    state.orders = [{'id': 1}]
+    first = state.snapshot()
+    assert first.countries.AU.population == 1
+    assert first.orders[0].id == 1
+    with pytest.raises(TypeError):
+        first.countries.AU.population = 5
+
+    state.countries.AU.population = 3
+    del state.countries['RU']
+    state.orders[0].id = 2
+    second = state.snapshot()
+    assert first.countries.AU.population == 1
+    assert second.countries.AU.population == 3
+
+    # Unchanged subtrees are shared.
+    assert state.snapshot() is second
+    state.user.name = 'Alice'
+    assert state.snapshot().countries is second.countries
+
+    assert sorted(first.diff(second)) == [
+        ('state.countries.AU.population', 1, 3, 'set'),
+        ('state.countries.RU', first.countries.RU, app_state.MISSING, 'delete'),
+        ('state.orders.0.id', 1, 2, 'set'),
+    ]
+    assert second.as_dict()['orders'] == [{'id': 2}]
+
+    # Only the last snapshot is kept, to share subtrees with the next one.
+    countries = weakref.ref(second.countries)
+    order = weakref.ref(second.orders[0])
+    del first, second
+    state.orders[0].id = 3
+    assert state.snapshot().countries is countries()
+    assert order() is None
+    assert state.snapshot().orders == ({'id': 3},)
+
+
+def test_undo_redo():
+    calls = []
+    state.document = {'title': 'Draft', 'lines': ['a']}
+    state.track_history('state.document', limit=2)
+
+    @on('state.document')
+    def document(changes):
+        calls.append(len(changes))
+
+    state.document.title = 'First'
+    with state.batch():
+        state.document.title = 'Second'
+        state.document.lines.append('b')
+        state.user.name = 'Alice'  # Not tracked
+    with pytest.raises(ValueError), state.transaction():
+        state.document.title = 'Reverted'
+        raise ValueError
+
+    # Handlers are called once per undo, with all changes of the batch.
+    calls.clear()
+    assert state.undo()
+    assert state.document.title == 'First'
+    assert state.document.lines == ['a']
+    assert state.user.name == 'Alice'
+    assert calls == [2]
+
+    assert state.undo()
+    assert state.document.title == 'Draft'
+    # Older entries were evicted.
+    assert not state.undo()
+
+    assert state.redo()
+    assert state.redo()
+    assert state.document.as_dict() == {'title': 'Second', 'lines': ['a', 'b']}
+    assert not state.redo()
+
+    # New change discards undone entries.
+    state.undo()
+    state.document.title = 'Third'
+    assert not state.redo()
+
+    # Undone values are rolled back with the enclosing transaction.
+    with pytest.raises(ValueError), state.transaction():
+        state.undo()
+        raise ValueError
+    assert state.document.title == 'Third'
+
+    document.disconnect()
+    state.track_history(enabled=False)
+    assert not state.undo()
+
+
+def test_undo_persisted(tmp_path: Path):
+    state.autopersist(tmp_path / 'state', timeout=0)
+    state.track_history('state.doc')
+    state.doc = {'title': 'a'}
+    state.doc.title = 'b'
+    state.undo()
+    assert state.doc.title == 'a'
+
+    app_state.persisted = None
+    state.reset()
+    state.reload(tmp_path / 'state')
+    assert state.doc.title == 'a'
+    state.track_history(enabled=False)
+
+
+def test_profile(tmp_path: Path):
+    import json
+    on.profile(trace=True)
+    state.autopersist(tmp_path / 'state', timeout=0)
+
+    @on('state.user')
+    def on_user():
+        pass
+
+    state.user.name = 'Alice'
+    state.user.name = 'Bob'
+
+    stats = on.stats()
+    assert stats['handlers']['test.test_profile.<locals>.on_user']['calls'] == 2
+    assert stats['paths']['state.user.name'] == {'triggers': 2, 'handlers': 4, 'max': 2}
+    assert stats['flushes']['journal']['count'] == 2
+    assert stats['flushes']['journal']['bytes'] > 0
+
+    on.export_trace(tmp_path / 'trace.json')
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    assert [x['name'] for x in events if x['cat'] == 'persistence'] == ['flush journal'] * 2
+
+    on.profile(False)
+    on_user.disconnect()
+    assert on.stats()['handlers'] == {}
+
+
+def test_import_time():
+    import os
+    import subprocess
+    import sys
+
+    # Import of app_state itself and its dependencies, microseconds.
+    budget = 300_000
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).parent / 'src'))
+    env['APP_STATE_KIVY'] = '0'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import app_state, sys; print("kivy" in sys.modules, "trio" in sys.modules)'],
+        capture_output=True, text=True, check=True, env=env,
+    )
+    assert result.stdout.split() == ['False', 'False']
+    line = [x for x in result.stderr.splitlines() if x.endswith('| app_state')][0]
+    assert int(line.split('|')[1]) < budget
+
+
+def test_subnodes_are_canonical():
+    state.countries = {'AU': {'info': {'population': 1}}}
+
+    assert state.countries.AU is state.countries.AU
+    assert state['countries']['AU'] is state.countries.get('AU')
+    assert state.countries.AU.info._appstate_path == 'state.countries.AU.info'
+
+    # Node assigned to another branch is copied with its own path.
+    state.backup = state.countries
+    assert state.backup == state.countries
+    assert state.backup.AU is not state.countries.AU
+    assert state.backup.AU.info._appstate_path == 'state.backup.AU.info'
+
+
+def test_compact_nodes():
+    state.countries = {'AU': {'info': {'population': 1}}}
+    state.countries.AU._cache = {'x': 1}
+
+    # Nodes have no __dict__, underscore attributes are kept aside.
+    assert not hasattr(state.countries.AU, '__dict__')
+    assert state.countries.AU._cache.x == 1
+    assert state.countries.AU._cache._appstate_path == 'state.countries.AU._cache'
+    assert 'AU' in state.countries.as_dict(full=True)
+
+    # Paths follow items shifted in a list.
+    state.orders = [{'id': 1}, {'id': 2}]
+    order = state.orders[1]
+    state.orders.insert(0, {'id': 0})
+    assert order is state.orders[2]
+    assert order._appstate_path == 'state.orders.2'
+
+    # Parent links are weak: a replaced subtree is freed without the gc.
+    info = weakref.ref(state.countries.AU.info)
+    state.countries = {}
+    assert info() is None
+
+
+def test_list_node(mocker):
+    handler = Mock()
+    subscription = on('state.orders.1')(handler)
+
+    state.orders = [{'id': 1}, {'id': 2}]
+    assert isinstance(state.orders, app_state.ListNode)
+    assert state.orders is state.orders
+    assert state.orders[1] is state.orders[1]
+    assert state.orders[1]._appstate_path == 'state.orders.1'
+    assert handler.call_count == 1
+
+    state.orders[1].id = 3
+    assert handler.call_count == 2
+    state.orders.append({'id': 4})
+    assert handler.call_count == 2
+
+    # In-place addition signals once, not again on reassignment.
+    changes = []
+
+    @on('state.orders')
+    def orders(change):
+        changes.append(change)
+
+    state.orders += [{'id': 5}]
+    assert len(changes) == 1
+    assert state.orders.pop() == {'id': 5}
+    orders.disconnect()
+
+    # Insertion shifts items, signalling the whole list.
+    state.orders.insert(0, {'id': 0})
+    assert handler.call_count == 3
+    assert state.orders[1]._appstate_path == 'state.orders.1'
+    assert state.orders[3]._appstate_path == 'state.orders.3'
+
+    state.orders[1:3] = [{'id': 'x'}]
+    assert state.orders.pop() == {'id': 4}
+    assert state.orders == [{'id': 0}, {'id': 'x'}]
+    assert state.as_dict() == {'orders': [{'id': 0}, {'id': 'x'}]}
+
+    with pytest.raises(ValueError):
+        with state.transaction():
+            state.orders.clear()
+            raise ValueError
+    assert state.orders == [{'id': 0}, {'id': 'x'}]
+    subscription.disconnect()
+
+
+def test_autopersist_journal(tmp_path: Path):
+    state.autopersist(tmp_path / 'state', timeout=0)
+    state.countries = {'AU': {'population': 1}, 'RU': {'population': 2}}
+    state.user = 'Alice'
+
+    storage = state._appstate_storage
+    storage.compact(state)
+    snapshot = storage.snapshot.read_bytes()
+    journal_size = storage.journal.stat().st_size
+
+    state.countries.AU.population = 3
+
+    # Only the changed subtree is appended to the journal.
+    assert storage.snapshot.read_bytes() == snapshot
+    assert storage.journal.stat().st_size > journal_size
+
+    # Record torn by a crash is discarded.
+    with open(storage.journal, 'ab') as f:
+        f.write(b'\x80\x05garbage')
+
+    state.reload(tmp_path / 'state')
+    assert state == {
+        'countries': {'AU': {'population': 3}, 'RU': {'population': 2}},
+        'user': 'Alice',
+    }
+
+    storage = state._appstate_storage
+    storage.compact(state)
+    assert storage.journal.stat().st_size == journal_size
+    state.reload(tmp_path / 'state')
+    assert state.countries.AU.population == 3
+
+
+def test_autopersist_marks_keys(tmp_path: Path):
+    def reopen(**kwargs):
+        app_state.persisted = None
+        state.reset()
+        state.autopersist(tmp_path / 'state', timeout=0, **kwargs)
+
+    # Keys set before autopersist() are written too.
+    state.config = {'theme': 'dark'}
+    state.autopersist(tmp_path / 'state', timeout=0)
+    state.user = 'Alice'
+    reopen()
+    assert state == {'config': {'theme': 'dark'}, 'user': 'Alice'}
+
+    # Changes without signals are written on the next flush.
+    state.update({'b': 2}, signal=False)
+    state.user = 'Bob'
+    reopen()
+    assert state.b == 2
+
+    # Keys which are not strings, or contain dots.
+    state['a.b'] = 1
+    state.scores = {5: 'five'}
+    reopen(depth=2)
+    state.scores[5] = 'FIVE'
+    state.scores[6] = {'x': 1}
+    state.scores[6] = 'six'
+    reopen(depth=2)
+    assert state['a.b'] == 1
+    assert state.scores == {5: 'FIVE', 6: 'six'}
+
+
+@pytest.mark.asyncio
+async def test_autopersist_threads(tmp_path: Path, mocker):
+    mocker.patch.object(app_state, 'threads', None)
+    state.threadsafe()
+    import asyncio
+    import threading
+
+    state.autopersist(tmp_path / 'state', timeout=0, depth=2)
+    state.workers = {str(x): {} for x in range(8)}
+
+    def work(name):
+        for i in range(3000):
+            state.workers[name][str(i)] = i
+
+    threads = [threading.Thread(target=work, args=(str(x),)) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    # Flushing while other threads write.
+    while any(thread.is_alive() for thread in threads):
+        state._appstate_storage.flush(state)
+        state._appstate_storage.compact(state)
+        await asyncio.sleep(0)
+    for thread in threads:
+        thread.join()
+    await asyncio.sleep(0)
+    state._appstate_storage.flush(state)
+
+    app_state.persisted = None
+    state.reset()
+    state.reload(tmp_path / 'state')
+    assert all(len(state.workers[str(x)]) == 3000 for x in range(8))
+
+
+def test_autopersist_legacy_shelve(tmp_path: Path):
+    import shelve
+    with shelve.open(str(tmp_path / 'state')) as legacy:
+        legacy['state'] = {'user': 'Alice'}
+
+    state.autopersist(tmp_path / 'state', timeout=0)
+    assert state == {'user': 'Alice'}
+
+
+def test_autopersist_lazy(tmp_path: Path):
+    state.autopersist(tmp_path / 'state', timeout=0, depth=2)
+    state.countries = {'AU': {'population': 1}, 'RU': {'population': 2}}
+    state.user = {'name': 'Alice'}
+    state._appstate_storage.compact(state)
+    state.countries.AU.population = 3
+
+    state.autopersist(tmp_path / 'state', timeout=0, depth=2, lazy=True)
+    assert isinstance(state.data['countries'], app_state.LazyBranch)
+    assert isinstance(state.data['user'], app_state.LazyBranch)
+
+    # Branch is deserialized on first access, with journal changes applied.
+    assert state.countries.AU.population == 3
+    assert isinstance(state.data['countries'], app_state.DictNode)
+    assert isinstance(state.data['user'], app_state.LazyBranch)
+
+    # Untouched branch is written to the new snapshot as is.
+    state._appstate_storage.compact(state)
+    assert isinstance(state.data['user'], app_state.LazyBranch)
+    assert state == {
+        'countries': {'AU': {'population': 3}, 'RU': {'population': 2}},
+        'user': {'name': 'Alice'},
+    }
+
+    # Handlers don't get the placeholders of branches not loaded yet.
+    state.autopersist(tmp_path / 'state', timeout=0, depth=2, lazy=True)
+    received = []
+
+    @on('state.user')
+    def handler(change):
+        received.append(change)
+
+    state.update({'user': {'name': 'Alice'}})
+    assert received == []
+    state.autopersist(tmp_path / 'state', timeout=0, depth=2, lazy=True)
+    received.clear()
+    state.user = 'Bob'
+    assert received == [('state.user', {'name': 'Alice'}, 'Bob', 'set')]
+    handler.disconnect()
+
+
+@pytest.mark.parametrize('format', ['pickle', 'json', 'marshal', 'json+zlib', 'msgpack', 'marshal+zstd'])
+def test_autopersist_format(tmp_path: Path, format):
+    if format.startswith('msgpack'):
+        pytest.importorskip('msgpack')
+    if format.endswith('zstd'):
+        pytest.importorskip('zstandard')
+
+    state.autopersist(tmp_path / 'state', timeout=0, format=format)
+    state.countries = {'AU': {'population': 1, 'cities': ['Sydney']}}
+    state._appstate_storage.compact(state)
+    state.countries.AU.population = 3
+
+    state.reload(tmp_path / 'state')
+    assert state == {'countries': {'AU': {'population': 3, 'cities': ['Sydney']}}}
+
+    # File written with another format is converted.
+    state.autopersist(tmp_path / 'state', timeout=0, format='json')
+    state._appstate_storage.flush(state)
+    with open(tmp_path / 'state.snapshot', 'rb') as f:
+        assert pickle.load(f)['format'] == 'json'
+    state.reload(tmp_path / 'state')
+    assert state == {'countries': {'AU': {'population': 3, 'cities': ['Sydney']}}}
+
+
+def test_autopersist_custom_format(tmp_path: Path, mocker):
+    mocker.patch.dict(app_state.codecs)
+
+    class ReprCodec(app_state.Codec):
+        name = 'repr'
+
+        def dumps(self, value) -> bytes:
+            return repr(value).encode()
+
+        def loads(self, blob: bytes):
+            return eval(blob)
+
+    state.autopersist(tmp_path / 'state', timeout=0, format=ReprCodec())
+    state.countries = {'AU': {'population': 1}}
+    state._appstate_storage.compact(state)
+
+    # Registered codec reads the file after switching the format.
+    state.autopersist(tmp_path / 'state', timeout=0, format='json')
+    assert state == {'countries': {'AU': {'population': 1}}}
+    state._appstate_storage.flush(state)
+
+    # Unknown format falls back to the given codec.
+    codec = app_state.JsonCodec()
+    codec.name = 'json-v2'
+    state.autopersist(tmp_path / 'state', timeout=0, format=codec)
+    assert state == {'countries': {'AU': {'population': 1}}}
+
+
+def test_change_payload():
+    received = []
+
+    @on('state.user')
+    def on_user(change):
+        received.append(change)
+
+    @on('state.user')
+    def on_user_batch(changes, paths):
+        received.append((changes, paths))
+
+    state.user.name = 'Alice'
+    assert received[0] == ('state.user.name', app_state.MISSING, 'Alice', 'set')
+    assert received[0].op == 'set'
+
+    received.clear()
+    state.user.update({'name': 'Bob', 'age': 30})
+    assert received[0] == ('state.user.age', app_state.MISSING, 30, 'set')
+    assert received[1][0] == [
+        ('state.user.name', 'Alice', 'Bob', 'set'),
+        ('state.user.age', app_state.MISSING, 30, 'set'),
+    ]
+
+    received.clear()
+    with state.batch():
+        del state.user['age']
+        state.user.name = 'Carol'
+    change, (changes, paths) = received
+    assert change.path == 'state.user.name'
+    assert changes == [
+        ('state.user.age', 30, app_state.MISSING, 'delete'),
+        ('state.user.name', 'Bob', 'Carol', 'set'),
+    ]
+    assert paths == ['state.user.age', 'state.user.name']
+
+    on_user.disconnect()
+    on_user_batch.disconnect()
+
+
+def test_update_diff():
+    state.countries = {'AU': {'population': 1, 'cities': ['Sydney']}, 'RU': {'population': 2}}
+    au = state.countries.AU
+    received = []
+    handler = on('state.countries')(lambda changes: received.extend(changes))
+
+    state.countries.update({'AU': {'population': 1, 'cities': ['Sydney']}, 'RU': {'population': 2}})
+    assert received == []
+
+    state.countries.update({'AU': {'population': 3, 'cities': ['Perth']}})
+    assert [x[:3] for x in received] == [
+        ('state.countries.AU.population', 1, 3),
+        ('state.countries.AU.cities.0', 'Sydney', 'Perth'),
+    ]
+    # Changed subtree is updated in place.
+    assert state.countries.AU is au
+
+    received.clear()
+    state.countries.update(RU={})
+    assert received == [('state.countries.RU.population', 2, app_state.MISSING, 'delete')]
+    assert state == {'countries': {'AU': {'population': 3, 'cities': ['Perth']}, 'RU': {}}}
+    handler.disconnect()
+
+
+def test_version():
+    state.countries = {'AU': {'population': 1}, 'RU': {'cities': ['Moscow']}}
+    seen = state._appstate_version
+    au = state.countries.AU._appstate_version
+    ru = state.countries.RU._appstate_version
+
+    state.countries.RU.cities.append('Kazan')
+
+    assert state.changed_since(seen)
+    assert state.countries.changed_since(seen)
+    assert state.countries.RU.changed_since(ru)
+    assert state.countries.RU.cities.changed_since(ru)
+    assert not state.countries.AU.changed_since(au)
+
+    seen = state._appstate_version
+    state.countries.AU.update({'population': 1})
+    assert not state.changed_since(seen)
+
+
+def test_attach_detached_node():
+    node = state.countries.AU.cities
+    assert 'countries' not in state
+
+    seen = state._appstate_version
+    node.Perth = 1
+    assert state.countries.AU.cities is node
+    assert state.changed_since(seen)
+
+    # Once attached, the node is written in place.
+    state.countries.RU = {}
+    node.Sydney = 2
+    assert state == {'countries': {'AU': {'cities': {'Perth': 1, 'Sydney': 2}}, 'RU': {}}}
+
+
+def test_computed():
+    state.countries = {'AU': {'population': 1}, 'RU': {'population': 2}}
+    calls = []
+
+    @app_state.computed
+    def total():
+        calls.append(1)
+        return sum(x.population for x in state.countries.values())
+
+    @app_state.computed
+    def doubled():
+        return total() * 2
+
+    assert total() == 3
+    assert total() == 3
+    assert len(calls) == 1
+
+    received = []
+
+    @on(doubled)
+    def on_doubled(change):
+        received.append((change.old, change.new))
+
+    # Handler reading the computed value sees the new one.
+    @on('state.countries')
+    def read_total():
+        received.append(total())
+
+    assert doubled() == 6
+    state.countries.AU.population = 5
+    assert total() == 7
+    assert sorted(received, key=str) == [(6, 14), 7]
+
+    # Unrelated change does not invalidate.
+    state.user = 'Alice'
+    assert total() == 7
+    assert len(calls) == 2
+
+    # Change not affecting the value does not trigger subscribers.
+    received.clear()
+    state.countries.RU.code = 'RU'
+    assert received == [7]
+    assert len(calls) == 3
+
+    # New key invalidates value computed by iteration.
+    state.countries.US = {'population': 10}
+    assert doubled() == 34
+
+    on_doubled.disconnect()
+    read_total.disconnect()
+    doubled.disconnect()
+    total.disconnect()
+    handlers = [x.handler for x in (total, doubled)]
+    assert not set(handlers) & set(on.match('state.countries.AU.population'))
+    assert total() == 17
+    total.disconnect()